@@ -0,0 +1,66 @@
+"""
+Compara la extracción actual (file.read() + parse_xml_and_generate_insert) con la extracción
+en streaming (extract_factura_from_file + generate_insert_sql) para facturas con distinta
+cantidad de líneas de detalle.
+
+Uso (desde la raíz del proyecto):
+    uv run python -m benchmarks.bench_extract
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.synthetic_siat import make_invoice
+from src.xml_to_sql import extract_factura_from_file, generate_insert_sql, parse_xml_and_generate_insert
+
+def write_invoice(path, detalle_count):
+    """Writes a synthetic SIAT invoice with detalle_count detail lines."""
+    _, xml_text, _ = make_invoice(random.Random(detalle_count), 94, detalle_count)
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(xml_text)
+
+def current_path(xml_path):
+    with open(xml_path, 'r', encoding='utf-8') as file:
+        xml_string = file.read()
+    return parse_xml_and_generate_insert(xml_string, 1)
+
+def streaming_path(xml_path):
+    return generate_insert_sql(extract_factura_from_file(xml_path), 1)
+
+def measure(func, xml_path, repeat):
+    """Returns (best_seconds, peak_bytes) for func(xml_path)."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(xml_path)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    func(xml_path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--detalles", type=int, nargs="+", default=[10, 1_000, 10_000, 50_000],
+                        help="Cantidades de líneas de detalle a probar.")
+    parser.add_argument("--repeat", type=int, default=5, help="Repeticiones por medición (se reporta la mejor).")
+    args = parser.parse_args()
+
+    print(f"{'detalles':>9} {'tamaño':>10} {'actual ms':>10} {'actual MiB':>11} {'stream ms':>10} {'stream MiB':>11}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in args.detalles:
+            xml_path = os.path.join(tmp, f"BENCH{count}.xml")
+            write_invoice(xml_path, count)
+            assert current_path(xml_path) == streaming_path(xml_path)
+            current_s, current_peak = measure(current_path, xml_path, args.repeat)
+            stream_s, stream_peak = measure(streaming_path, xml_path, args.repeat)
+            print(f"{count:>9} {os.path.getsize(xml_path) / 2**20:>8.2f}MB "
+                  f"{current_s * 1000:>10.2f} {current_peak / 2**20:>11.2f} "
+                  f"{stream_s * 1000:>10.2f} {stream_peak / 2**20:>11.2f}")
+
+if __name__ == "__main__":
+    main()
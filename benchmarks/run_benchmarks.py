@@ -0,0 +1,290 @@
+"""
+Benchmark de la ingesta completa sobre un árbol de facturas SIAT sintéticas.
+
+Mide por etapa (búsqueda por CUF, parseo, armado de SQL, inserción y subida) la latencia
+p50/p99, archivos/s y MB/s, además del pico de memoria (RSS), y emite el resultado como JSON
+para poder comparar corridas.
+
+Uso (desde la raíz del proyecto):
+    uv run python -m benchmarks.run_benchmarks --facturas 2000 --output resultado.json
+
+La inserción se mide por defecto contra SQLite en memoria; con --mysql-config se usa la sección
+[DATABASE] de ese archivo (usar una base desechable, por ejemplo un contenedor). La subida se
+mide contra moto si está instalado. El tiempo de importación de los módulos (el costo de arranque
+de cada ejecución) se mide en intérpretes nuevos.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+
+from benchmarks.synthetic_siat import generate_tree
+from src.cuf_index import build_cuf_index
+from src.metrics import metrics
+from src.xml_to_sql import (
+    FACTURA_SIAT_COLUMNS,
+    extract_factura_from_file,
+    find_xml_by_cuf,
+    generate_insert_sql,
+    insert_rows,
+)
+
+SQLITE_DDL = """
+CREATE TABLE factura_siat (
+    factura_id INTEGER, cuf TEXT, cufd TEXT, codigoSucursal INTEGER, codigoPuntoVenta INTEGER,
+    fechaEmision TEXT, codigoTipoDocumentoIdentidad INTEGER, numeroDocumento TEXT, complemento TEXT,
+    nombreRazonSocial TEXT, leyenda TEXT, pedido TEXT, cafc TEXT, codigoRecepcion TEXT,
+    codigoMetodoPago INTEGER, numeroTarjeta TEXT, montoTotal NUMERIC, montoTotalMoneda NUMERIC,
+    tipoCambio NUMERIC, created_at TEXT
+)
+"""
+
+class _SQLiteCursor:
+    """Adapts the %s placeholders used with mysql.connector to sqlite3."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, query, params=()):
+        self._cursor.execute(query.replace("%s", "?"), params)
+
+    def executemany(self, query, seq_of_params):
+        self._cursor.executemany(query.replace("%s", "?"), seq_of_params)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        self._cursor.close()
+
+class _SQLiteConnection:
+    """Minimal stand-in for a mysql.connector connection backed by an in-memory SQLite database."""
+
+    def __init__(self):
+        sqlite3.register_adapter(Decimal, str)
+        self._conn = sqlite3.connect(":memory:")
+        self._conn.execute(SQLITE_DDL)
+
+    def cursor(self):
+        return _SQLiteCursor(self._conn.cursor())
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        self._conn.close()
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def summarize(latencies, elapsed, files=None, total_bytes=None):
+    """Builds the JSON entry of a stage from its per-operation latencies (seconds)."""
+    ordered = sorted(latencies)
+    result = {
+        "operations": len(ordered),
+        "elapsed_s": round(elapsed, 6),
+        "p50_ms": round(percentile(ordered, 50) * 1000, 4) if ordered else None,
+        "p99_ms": round(percentile(ordered, 99) * 1000, 4) if ordered else None,
+    }
+    if files is not None and elapsed > 0:
+        result["files_per_s"] = round(files / elapsed, 2)
+    if total_bytes is not None and elapsed > 0:
+        result["mb_per_s"] = round(total_bytes / 2**20 / elapsed, 3)
+    return result
+
+def _timed(func, items):
+    """Runs func over items, returning (results, latencies, elapsed)."""
+    results = []
+    latencies = []
+    start = time.perf_counter()
+    for item in items:
+        t0 = time.perf_counter()
+        results.append(func(item))
+        latencies.append(time.perf_counter() - t0)
+    return results, latencies, time.perf_counter() - start
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return round(peak / 2**20 if sys.platform == "darwin" else peak / 1024, 2)
+
+# Modules whose import time is measured; the last two are the heavy dependencies that the
+# parse-only paths are expected not to load
+IMPORT_MODULES = ("src.xml_to_sql", "src.ingest", "src.export", "main", "mysql.connector", "boto3")
+HEAVY_MODULES = ("mysql.connector", "boto3")
+
+_IMPORT_PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(elapsed, *[name for name in {heavy!r} if name in sys.modules])
+"""
+
+def bench_import(modules=IMPORT_MODULES, repeat=5):
+    """Import time of each module in a fresh interpreter (p50 of repeat runs) and the heavy modules it loads."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = {}
+    for module in modules:
+        times = []
+        for _ in range(repeat):
+            proc = subprocess.run([sys.executable, "-c", _IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                                  cwd=root, capture_output=True, text=True)
+            if proc.returncode != 0:
+                break
+            elapsed, *loaded = proc.stdout.split()
+            times.append(float(elapsed))
+        if not times:
+            results[module] = {"skipped": proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "error"}
+            continue
+        results[module] = {"ms_p50": round(statistics.median(times) * 1000, 2),
+                           "heavy_modules_loaded": [name for name in loaded if name != module]}
+    return {"import": results}
+
+def bench_lookup(base_path, cufs, sample_size, index_path):
+    sample = random.Random(1).sample(cufs, min(sample_size, len(cufs)))
+    stages = {}
+    _, latencies, elapsed = _timed(lambda cuf: find_xml_by_cuf(cuf, base_path), sample)
+    stages["lookup_walk"] = summarize(latencies, elapsed)
+    start = time.perf_counter()
+    build_cuf_index(index_path, base_path)
+    stages["index_build"] = summarize([], time.perf_counter() - start, files=len(cufs))
+    _, latencies, elapsed = _timed(lambda cuf: find_xml_by_cuf(cuf, base_path, index_path), sample)
+    stages["lookup_index"] = summarize(latencies, elapsed)
+    return stages
+
+def bench_insert(rows, batch_size, cnx, label):
+    chunks = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+    _, latencies, elapsed = _timed(lambda chunk: insert_rows(cnx, chunk, batch_size), chunks)
+    result = summarize(latencies, elapsed)
+    result["rows_per_s"] = round(len(rows) / elapsed, 2) if elapsed > 0 else None
+    result["batch_size"] = batch_size
+    return {label: result}
+
+def bench_upload(paths, total_bytes, workers):
+    try:
+        import boto3
+        from moto import mock_aws
+    except ImportError:
+        return {"upload_moto": {"skipped": "moto no está instalado"}}
+    from src.spaces import SpacesUploader
+
+    spaces_config = {"region_name": "us-east-1", "endpoint_url": "https://s3.amazonaws.com",
+                     "aws_access_key_id": "testing", "aws_secret_access_key": "testing",
+                     "bucket_name": "siat-bench", "upload_folder": "obs/xmls/"}
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1", aws_access_key_id="testing",
+                              aws_secret_access_key="testing")
+        client.create_bucket(Bucket=spaces_config["bucket_name"])
+        uploader = SpacesUploader(spaces_config, max_workers=workers, client=client)
+
+        def upload(path):
+            t0 = time.perf_counter()
+            uploader.upload(path)
+            return time.perf_counter() - t0
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            latencies = list(executor.map(upload, paths))
+        elapsed = time.perf_counter() - start
+    result = summarize(latencies, elapsed, files=len(paths), total_bytes=total_bytes)
+    result["workers"] = workers
+    return {"upload_moto": result}
+
+def run(args, base_path, workdir):
+    written = generate_tree(base_path, args.facturas, args.profundidad, args.fanout,
+                            (args.detalles_min, args.detalles_max), args.opcionales, args.semilla)
+    cufs = [cuf for cuf, _ in written]
+    paths = [path for _, path in written]
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {key: value for key, value in vars(args).items() if key not in ("output", "mysql_config")},
+        "dataset": {"files": len(paths), "bytes": total_bytes},
+        "stages": {},
+    }
+    stages = report["stages"]
+
+    stages.update(bench_import())
+    stages.update(bench_lookup(base_path, cufs, args.muestra_busqueda, os.path.join(workdir, "cuf_index.sqlite")))
+
+    facturas, latencies, elapsed = _timed(extract_factura_from_file, paths)
+    stages["parse"] = summarize(latencies, elapsed, files=len(paths), total_bytes=total_bytes)
+
+    _, latencies, elapsed = _timed(lambda factura: generate_insert_sql(factura, 1), facturas)
+    stages["sql_build"] = summarize(latencies, elapsed, files=len(facturas))
+    rows, latencies, elapsed = _timed(lambda factura: factura.to_row(1), facturas)
+    stages["row_build"] = summarize(latencies, elapsed, files=len(facturas))
+
+    cnx = _SQLiteConnection()
+    try:
+        stages.update(bench_insert(rows, args.batch_size, cnx, "insert_sqlite"))
+    finally:
+        cnx.close()
+    if args.mysql_config:
+        import mysql.connector
+        from src.xml_to_sql import get_db_config
+        cnx = mysql.connector.connect(**get_db_config(args.mysql_config))
+        try:
+            stages.update(bench_insert(rows, args.batch_size, cnx, "insert_mysql"))
+        finally:
+            cnx.close()
+
+    stages.update(bench_upload(paths, total_bytes, args.upload_workers))
+    report["peak_rss_mb"] = peak_rss_mb()
+    report["metrics"] = metrics.snapshot()
+    assert len(rows) == len(paths) and len(rows[0]) == len(FACTURA_SIAT_COLUMNS)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--facturas", type=int, default=2000, help="Cantidad de facturas sintéticas.")
+    parser.add_argument("--profundidad", type=int, default=2, help="Niveles de subdirectorios.")
+    parser.add_argument("--fanout", type=int, default=12, help="Subdirectorios por nivel.")
+    parser.add_argument("--detalles-min", type=int, default=1, help="Mínimo de líneas de detalle por factura.")
+    parser.add_argument("--detalles-max", type=int, default=20, help="Máximo de líneas de detalle por factura.")
+    parser.add_argument("--opcionales", type=float, default=0.3, help="Probabilidad de cada campo opcional.")
+    parser.add_argument("--semilla", type=int, default=0, help="Semilla aleatoria.")
+    parser.add_argument("--muestra-busqueda", type=int, default=50, help="CUFs buscados en la etapa de búsqueda.")
+    parser.add_argument("--batch-size", type=int, default=500, help="Filas por executemany en la etapa de inserción.")
+    parser.add_argument("--upload-workers", type=int, default=8, help="Subidas concurrentes en la etapa de subida.")
+    parser.add_argument("--mysql-config", default=None, help="Archivo de configuración de una base MySQL desechable.")
+    parser.add_argument("--output", default=None, help="Archivo JSON de salida (por defecto, la salida estándar).")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        report = run(args, os.path.join(workdir, "xml"), workdir)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
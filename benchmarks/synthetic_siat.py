@@ -0,0 +1,152 @@
+"""
+Generador de árboles de facturas SIAT sintéticas para pruebas de rendimiento.
+
+Uso (desde la raíz del proyecto):
+    uv run python -m benchmarks.synthetic_siat data/sintetico --facturas 10000 --profundidad 3 --manifiesto manifiesto.csv
+"""
+import argparse
+import csv
+import os
+import random
+from datetime import datetime, timedelta
+from decimal import Decimal
+from xml.sax.saxutils import escape
+
+HEADER = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+ROOT_OPEN = ('<facturaElectronicaCompraVenta xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+             'xsi:noNamespaceSchemaLocation="facturaElectronicaCompraVenta.xsd">')
+ROOT_CLOSE = '</facturaElectronicaCompraVenta>'
+LEYENDA = ("Ley N° 453: Tienes derecho a recibir información sobre las características y contenidos "
+           "de los servicios que utilices.")
+CLIENTES = ["CLIENTE S.A.", "DISTRIBUIDORA O'HIGGINS S.R.L.", "JUAN PÉREZ", "COMERCIAL & SERVICIOS LTDA.",
+            "IMPORTADORA ANDINA", "FARMACIA \"LA SALUD\""]
+
+def _element(tag, value):
+    if value is None:
+        return f'<{tag} xsi:nil="true"/>'
+    return f"<{tag}>{escape(str(value))}</{tag}>"
+
+def make_invoice(rng, numero, detalle_count, optional_ratio=0.3, fecha=None):
+    """
+    Builds a synthetic SIAT invoice. Returns (cuf, xml_text, total) where total is the sum of
+    the detail subtotals (the cabecera montoTotal).
+    optional_ratio is the probability of each optional field (complemento, numeroTarjeta, cafc)
+    being present instead of nil.
+    """
+    cuf = "".join(rng.choice("0123456789ABCDEF") for _ in range(57))
+    fecha = fecha or datetime(2025, 1, 1) + timedelta(seconds=rng.randrange(365 * 24 * 3600))
+    detalles = []
+    total = Decimal("0")
+    for i in range(detalle_count):
+        cantidad = rng.randint(1, 20)
+        precio = Decimal(rng.randint(100, 100_000)) / 100
+        subtotal = precio * cantidad
+        total += subtotal
+        detalles.append(
+            "<detalle>"
+            + _element("actividadEconomica", "477300")
+            + _element("codigoProductoSin", "99100")
+            + _element("codigoProducto", f"PROD-{rng.randint(1, 99999):05d}")
+            + _element("descripcion", f"PRODUCTO DE PRUEBA {i}")
+            + _element("cantidad", cantidad)
+            + _element("unidadMedida", 58)
+            + _element("precioUnitario", precio)
+            + _element("montoDescuento", "0")
+            + _element("subTotal", subtotal)
+            + _element("numeroSerie", None)
+            + _element("numeroImei", None)
+            + "</detalle>"
+        )
+    metodo_tarjeta = rng.random() < optional_ratio
+    cabecera = (
+        "<cabecera>"
+        + _element("nitEmisor", "1020703023")
+        + _element("razonSocialEmisor", "EMPRESA S.R.L.")
+        + _element("municipio", "La Paz")
+        + _element("numeroFactura", numero)
+        + _element("cuf", cuf)
+        + _element("cufd", "BQUE+QytqQUDBKVUFOSVRPQkxVRFZCREFGNkNBQjIxQTAxMDAwMDAwMA==")
+        + _element("codigoSucursal", rng.randint(0, 3))
+        + _element("direccion", "AV. ARCE 123")
+        + _element("codigoPuntoVenta", rng.randint(0, 2))
+        + _element("fechaEmision", fecha.strftime("%Y-%m-%dT%H:%M:%S.") + f"{rng.randrange(1000):03d}")
+        + _element("nombreRazonSocial", rng.choice(CLIENTES))
+        + _element("codigoTipoDocumentoIdentidad", rng.choice([1, 5]))
+        + _element("numeroDocumento", rng.randint(100000, 99999999))
+        + _element("complemento", "1A" if rng.random() < optional_ratio else None)
+        + _element("codigoCliente", rng.randint(1, 9999))
+        + _element("codigoMetodoPago", 2 if metodo_tarjeta else 1)
+        + _element("numeroTarjeta", "4797000000007896" if metodo_tarjeta else None)
+        + _element("montoTotal", total)
+        + _element("montoTotalSujetoIva", total)
+        + _element("codigoMoneda", 1)
+        + _element("tipoCambio", 1)
+        + _element("montoTotalMoneda", total)
+        + _element("montoGiftCard", None)
+        + _element("descuentoAdicional", "0")
+        + _element("codigoExcepcion", None)
+        + _element("cafc", "1011917833B0D" if rng.random() < optional_ratio else None)
+        + _element("leyenda", LEYENDA)
+        + _element("usuario", "usuario")
+        + _element("codigoDocumentoSector", 1)
+        + "</cabecera>"
+    )
+    return cuf, HEADER + ROOT_OPEN + cabecera + "".join(detalles) + ROOT_CLOSE, total
+
+def _dir_for(index, depth, fanout):
+    """Spreads files over a directory tree `depth` levels deep with `fanout` subdirectories per level."""
+    parts = []
+    for level in range(depth):
+        parts.append(f"n{level}_{(index // (fanout ** (depth - level - 1))) % fanout:03d}")
+    return os.path.join(*parts) if parts else ""
+
+def generate_tree(base_path, count, depth=2, fanout=12, detalles=(1, 20), optional_ratio=0.3, seed=0,
+                  manifest_path=None):
+    """
+    Writes `count` synthetic invoices named <CUF>.xml under base_path.
+    detalles is the (min, max) number of detail lines per invoice.
+    If manifest_path is given, a manifest CSV usable by `main.py lote` is written too.
+    Returns the list of (cuf, xml_path).
+    """
+    rng = random.Random(seed)
+    written = []
+    manifest_file = open(manifest_path, 'w', encoding='utf-8', newline='') if manifest_path else None
+    try:
+        writer = None
+        if manifest_file:
+            writer = csv.writer(manifest_file)
+            writer.writerow(["cuf", "factura_id", "pedido", "numero_factura", "total_factura"])
+        for i in range(count):
+            cuf, xml_text, total = make_invoice(rng, i + 1, rng.randint(*detalles), optional_ratio)
+            directory = os.path.join(base_path, _dir_for(i, depth, fanout))
+            os.makedirs(directory, exist_ok=True)
+            xml_path = os.path.join(directory, f"{cuf}.xml")
+            with open(xml_path, 'w', encoding='utf-8') as file:
+                file.write(xml_text)
+            written.append((cuf, xml_path))
+            if writer:
+                writer.writerow([cuf, 100000 + i, f"PO {i}" if i % 2 else "", i + 1, total])
+    finally:
+        if manifest_file:
+            manifest_file.close()
+    return written
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("base_path", help="Directorio donde se escriben los XML.")
+    parser.add_argument("--facturas", type=int, default=1000, help="Cantidad de facturas.")
+    parser.add_argument("--profundidad", type=int, default=2, help="Niveles de subdirectorios.")
+    parser.add_argument("--fanout", type=int, default=12, help="Subdirectorios por nivel.")
+    parser.add_argument("--detalles-min", type=int, default=1, help="Mínimo de líneas de detalle por factura.")
+    parser.add_argument("--detalles-max", type=int, default=20, help="Máximo de líneas de detalle por factura.")
+    parser.add_argument("--opcionales", type=float, default=0.3,
+                        help="Probabilidad de que cada campo opcional (complemento, numeroTarjeta, cafc) esté presente.")
+    parser.add_argument("--semilla", type=int, default=0, help="Semilla aleatoria.")
+    parser.add_argument("--manifiesto", default=None, help="Escribe además un manifiesto CSV para `main.py lote`.")
+    args = parser.parse_args()
+    written = generate_tree(args.base_path, args.facturas, args.profundidad, args.fanout,
+                            (args.detalles_min, args.detalles_max), args.opcionales, args.semilla, args.manifiesto)
+    print(f"{len(written)} facturas escritas en {args.base_path}")
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
+import logging
+
 from src.xml_to_sql import procesar_e_insertar_factura
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
     # --- Configuración de la Factura a Procesar ---
     cuf_factura = "447D97004336CA901C7AFAE366C66201411A70EEC1437D0299D542F74"
     id_factura_db = 111730
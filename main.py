@@ -1,6 +1,351 @@
-def main():
-    print("Hello from siat-xml-to-sql!")
+import argparse
+import logging
+import os
+
+from src.cuf_index import DEFAULT_INDEX_FILE, build_cuf_index, update_cuf_index, verify_cuf_index
+from src.metrics import metrics, profile_run
+from src.xml_to_sql import LOAD_MODES
+
+
+def cmd_index(args):
+    """Construye, actualiza o verifica el índice persistente de CUFs."""
+    if args.accion == "build":
+        stats = build_cuf_index(args.index, args.base_path)
+        print(f"Índice reconstruido: {stats['files_indexed']} archivos XML en {stats['dirs_scanned']} directorios.")
+    elif args.accion == "update":
+        stats = update_cuf_index(args.index, args.base_path)
+        print(f"Índice actualizado: {stats['dirs_scanned']} directorios re-escaneados, "
+              f"{stats['dirs_skipped']} sin cambios, {stats['dirs_removed']} eliminados.")
+    else:
+        result = verify_cuf_index(args.index, args.base_path, repair=args.reparar)
+        print(f"Archivos indexados: {result['indexed']}")
+        print(f"Archivos faltantes: {len(result['missing'])}")
+        print(f"Archivos modificados: {len(result['changed'])}")
+        for cuf in result['missing']:
+            print(f"  - faltante: {cuf}")
+        for cuf in result['changed']:
+            print(f"  - modificado: {cuf}")
+        if args.reparar and (result['missing'] or result['changed']):
+            print("Índice reparado.")
+        return 0 if args.reparar or not (result['missing'] or result['changed']) else 1
+    return 0
+
+
+def cmd_lote(args):
+    """Procesa un manifiesto de facturas sin interacción del usuario."""
+    from src.batch import procesar_lote
+
+    summary = procesar_lote(args.manifiesto, args.base_path, args.config, args.reporte,
+                            subir=args.subir, index_path=args.index,
+                            batch_size=args.batch_size, commit_interval=args.commit_interval,
+                            upload_workers=args.upload_workers, skip_unchanged=not args.forzar_subida,
+                            upload_manifest_path=args.manifiesto_subidas, mode=args.modo)
+    if summary is None:
+        return 1
+    print("--- Resumen del lote ---")
+    for status, count in sorted(summary.items()):
+        print(f"  {status}: {count}")
+    return 0 if set(summary) <= {"ok", "skipped", "upload_skipped", "db_existing"} else 1
+
+
+def cmd_ingerir(args):
+    """Ingiere en paralelo todos los XML de un directorio."""
+    from src.ingest import ingerir_directorio
+
+    summary = ingerir_directorio(args.base_path, args.config, workers=args.workers, chunk_size=args.chunk_size,
+                                 queue_size=args.queue_size, batch_size=args.batch_size,
+                                 commit_interval=args.commit_interval, manifest_path=args.manifiesto,
+                                 mode=args.modo)
+    print("--- Resumen de la ingesta ---")
+    for status, count in sorted(summary.items()):
+        print(f"  {status}: {count}")
+    return 0 if not summary.get("db_error") and not summary.get("parse_error") else 1
+
+
+def cmd_ingerir_async(args):
+    """Procesa un manifiesto con el servicio asíncrono (aiomysql + aiobotocore)."""
+    from src.async_ingest import run_ingerir_async
+
+    summary = run_ingerir_async(args.manifiesto, args.base_path, args.config, args.reporte,
+                                subir=args.subir, index_path=args.index, max_in_flight=args.en_vuelo,
+                                pool_size=args.pool_size, mode=args.modo, skip_unchanged=not args.forzar_subida)
+    print("--- Resumen de la ingesta asíncrona ---")
+    for status, count in sorted(summary.items()):
+        print(f"  {status}: {count}")
+    return 0 if set(summary) <= {"ok", "skipped", "upload_skipped", "db_existing"} else 1
+
+
+def cmd_vigilar(args):
+    """Vigila una carpeta e ingiere los XML nuevos o modificados."""
+    from src.watcher import vigilar_carpeta
+
+    vigilar_carpeta(args.base_path, args.config, checkpoint_path=args.checkpoint, subir=args.subir,
+                    manifest_path=args.manifiesto, mode=args.modo, debounce=args.debounce,
+                    poll_interval=args.intervalo, polling=args.polling, upload_workers=args.upload_workers,
+                    upload_manifest_path=args.manifiesto_subidas)
+    return 0
+
+
+def cmd_outbox(args):
+    """Encola, drena o inspecciona los pasos pendientes del outbox."""
+    from src.outbox import Outbox, drenar_outbox, encolar_manifiesto
+
+    if args.accion == "encolar":
+        if not args.manifiesto:
+            print("Error: 'encolar' requiere --manifiesto.")
+            return 2
+        summary = encolar_manifiesto(args.outbox, args.manifiesto, args.base_path, args.index, subir=args.subir)
+        print("--- Facturas encoladas ---")
+        for status, count in sorted(summary.items()):
+            print(f"  {status}: {count}")
+        return 0 if set(summary) <= {"enqueued"} else 1
+    if args.accion == "drenar":
+        stats = drenar_outbox(args.outbox, args.config, esperar=not args.sin_esperar, batch_size=args.batch_size,
+                              upload_workers=args.upload_workers, mode=args.modo, max_attempts=args.max_intentos,
+                              upload_manifest_path=args.manifiesto_subidas)
+    else:
+        outbox = Outbox(args.outbox)
+        try:
+            if args.accion == "reintentar-muertos":
+                print(f"{outbox.retry_dead()} trabajos devueltos a la cola.")
+            stats = outbox.stats()
+            dead = outbox.dead_letters()
+        finally:
+            outbox.close()
+        for cuf, step, attempts, last_error in dead:
+            print(f"  - muerto: {cuf} ({step}, {attempts} intentos): {last_error}")
+    print("--- Estado del outbox ---")
+    for step, counts in sorted(stats.items()):
+        print(f"  {step}: " + ", ".join(f"{status}={count}" for status, count in sorted(counts.items())))
+    return 0 if not any(counts.get("dead") for counts in stats.values()) else 1
+
+
+def cmd_exportar(args):
+    """Exporta las cabeceras de un directorio de XML a Parquet, CSV (gzip) o TSV."""
+    from src.export import EXPORT_TSV, cargar_tsv, exportar_directorio, load_data_sql
+
+    try:
+        summary = exportar_directorio(args.base_path, args.salida, formato=args.formato,
+                                      row_group_size=args.row_group_size, manifest_path=args.manifiesto,
+                                      file_prefix=args.prefijo)
+    except RuntimeError as e:
+        # pyarrow (extra 'parquet') missing for the default format
+        print(f"Error: {e}")
+        return 2
+    print("--- Resumen de la exportación ---")
+    for status, count in sorted(summary.items()):
+        print(f"  {status}: {count}")
+    if args.formato == EXPORT_TSV:
+        tsv_path = os.path.join(args.salida, "factura_siat.tsv")
+        if args.cargar:
+            print(f"{cargar_tsv(tsv_path, args.config)} filas cargadas en factura_siat.")
+        else:
+            print("Para cargarlo en MySQL (con local_infile habilitado):")
+            print(f"  {load_data_sql(tsv_path)};")
+    return 0 if not summary.get("parse_error") else 1
+
+
+def cmd_salud(args):
+    """Comprueba en paralelo la conexión a MySQL y a Spaces."""
+    import json
+
+    from src.healthcheck import CHECKS, check_health
+
+    report = check_health(args.config, checks=(args.solo,) if args.solo else CHECKS, force=True,
+                          connect_timeout=args.timeout_conexion, read_timeout=args.timeout_lectura)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+    else:
+        for name, result in report["checks"].items():
+            estado = "ok" if result["ok"] else f"FALLO ({result['error_code']}): {result['error']}"
+            print(f"  {name}: {estado} [{result['latency_ms']} ms]")
+    return 0 if report["ok"] else 1
+
+
+def cmd_reconciliar(args):
+    """Compara los CUF del disco, de factura_siat y de Spaces."""
+    from src.reconcile import reconciliar
+
+    summary = reconciliar(args.config, args.base_path, index_path=args.index, output_path=args.salida,
+                          spaces=not args.sin_spaces, montos=args.montos,
+                          actualizar_indice=not args.sin_actualizar_indice, page_size=args.page_size,
+                          workers=args.workers)
+    print("--- Resumen de la reconciliación ---")
+    for status, count in sorted(summary.items()):
+        print(f"  {status}: {count}")
+    print(f"Diferencias escritas en '{args.salida}'.")
+    return 0 if set(summary) <= {"disk", "db", "spaces"} else 1
+
+
+def add_modo_argument(parser):
+    parser.add_argument("--modo", choices=LOAD_MODES, default="insert",
+                        help="insert: INSERT simple, upsert: actualiza los CUF existentes (requiere UNIQUE en cuf), "
+                             "skip: omite los CUF que ya están en factura_siat.")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Procesador de facturas SIAT (XML) para MySQL y DigitalOcean Spaces.")
+    parser.add_argument("--log-level", default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Nivel de los mensajes de progreso (por defecto solo advertencias y errores).")
+    parser.add_argument("--metricas", default=None,
+                        help="Escribe las métricas de la corrida: texto Prometheus si termina en .prom, si no JSON lines.")
+    parser.add_argument("--perfil", default=None, help="Ejecuta el comando bajo cProfile y guarda las estadísticas en este archivo.")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+
+    index_parser = subparsers.add_parser("index", help="Administra el índice persistente CUF -> archivo XML.")
+    index_parser.add_argument("accion", choices=["build", "update", "verify"],
+                              help="build: reconstruir desde cero, update: actualización incremental, verify: verificar contra el disco.")
+    index_parser.add_argument("--base-path", default=".", help="Directorio raíz de los archivos XML.")
+    index_parser.add_argument("--index", default=DEFAULT_INDEX_FILE, help="Ruta del archivo de índice (SQLite).")
+    index_parser.add_argument("--reparar", action="store_true", help="Con verify: re-escanea los directorios con entradas obsoletas.")
+    index_parser.set_defaults(func=cmd_index)
+
+    lote_parser = subparsers.add_parser("lote", help="Procesa un manifiesto CSV/JSONL de facturas (sin preguntas).")
+    lote_parser.add_argument("manifiesto", help="Archivo CSV o JSONL con cuf, factura_id, pedido, numero_factura, total_factura.")
+    lote_parser.add_argument("--base-path", default=".", help="Directorio raíz de los archivos XML.")
+    lote_parser.add_argument("--config", default="db_config.ini", help="Archivo de configuración.")
+    lote_parser.add_argument("--reporte", default="reporte_lote.jsonl", help="Reporte por fila (JSONL); permite reanudar el lote.")
+    lote_parser.add_argument("--subir", action="store_true", help="Sube cada XML a DigitalOcean Spaces después de insertarlo.")
+    lote_parser.add_argument("--index", default=None, help="Índice de CUFs a usar para las búsquedas (opcional).")
+    lote_parser.add_argument("--batch-size", type=int, default=500, help="Filas por executemany (INSERT multi-fila).")
+    lote_parser.add_argument("--commit-interval", type=int, default=1, help="Cantidad de executemany por commit.")
+    lote_parser.add_argument("--upload-workers", type=int, default=8, help="Subidas concurrentes a Spaces.")
+    lote_parser.add_argument("--forzar-subida", action="store_true",
+                             help="Sube los XML aunque su contenido ya esté en Spaces.")
+    lote_parser.add_argument("--manifiesto-subidas", default=None,
+                             help="Caché local (SQLite) de objetos subidos, evita consultar Spaces por archivos sin cambios.")
+    add_modo_argument(lote_parser)
+    lote_parser.set_defaults(func=cmd_lote)
+
+    ingerir_parser = subparsers.add_parser("ingerir", help="Ingiere en paralelo todos los XML de un directorio.")
+    ingerir_parser.add_argument("--base-path", default=".", help="Directorio raíz de los archivos XML.")
+    ingerir_parser.add_argument("--config", default="db_config.ini", help="Archivo de configuración.")
+    ingerir_parser.add_argument("--manifiesto", default=None,
+                                help="Manifiesto CSV/JSONL opcional con factura_id, pedido y datos a validar por CUF.")
+    ingerir_parser.add_argument("--workers", type=int, default=None, help="Procesos de parseo (por defecto, uno por núcleo).")
+    ingerir_parser.add_argument("--chunk-size", type=int, default=200, help="Archivos por bloque de trabajo.")
+    ingerir_parser.add_argument("--queue-size", type=int, default=8, help="Bloques de filas en espera hacia el escritor.")
+    ingerir_parser.add_argument("--batch-size", type=int, default=500, help="Filas por executemany (INSERT multi-fila).")
+    ingerir_parser.add_argument("--commit-interval", type=int, default=1, help="Cantidad de executemany por commit.")
+    add_modo_argument(ingerir_parser)
+    ingerir_parser.set_defaults(func=cmd_ingerir)
+
+    async_parser = subparsers.add_parser("ingerir-async",
+                                         help="Procesa un manifiesto insertando y subiendo cada factura en paralelo (asyncio).")
+    async_parser.add_argument("manifiesto", help="Archivo CSV o JSONL con cuf, factura_id, pedido, numero_factura, total_factura.")
+    async_parser.add_argument("--base-path", default=".", help="Directorio raíz de los archivos XML.")
+    async_parser.add_argument("--config", default="db_config.ini", help="Archivo de configuración.")
+    async_parser.add_argument("--reporte", default="reporte_async.jsonl", help="Reporte por fila (JSONL); permite reanudar.")
+    async_parser.add_argument("--subir", action="store_true", help="Sube cada XML a DigitalOcean Spaces en paralelo con la inserción.")
+    async_parser.add_argument("--index", default=None, help="Índice de CUFs a usar para las búsquedas (opcional).")
+    async_parser.add_argument("--en-vuelo", type=int, default=32, help="Facturas procesándose a la vez.")
+    async_parser.add_argument("--pool-size", type=int, default=10, help="Conexiones del pool de MySQL.")
+    async_parser.add_argument("--forzar-subida", action="store_true",
+                              help="Sube los XML aunque su contenido ya esté en Spaces.")
+    add_modo_argument(async_parser)
+    async_parser.set_defaults(func=cmd_ingerir_async)
+
+    vigilar_parser = subparsers.add_parser("vigilar", help="Vigila una carpeta e ingiere cada XML nuevo o modificado.")
+    vigilar_parser.add_argument("--base-path", default=".", help="Carpeta donde el sistema deja los XML.")
+    vigilar_parser.add_argument("--config", default="db_config.ini", help="Archivo de configuración.")
+    vigilar_parser.add_argument("--checkpoint", default="watch_checkpoint.sqlite",
+                                help="Registro (SQLite) de los archivos ya procesados; al reiniciar solo se procesan los nuevos.")
+    vigilar_parser.add_argument("--manifiesto", default=None,
+                                help="Manifiesto CSV/JSONL opcional con factura_id, pedido y datos a validar por CUF.")
+    vigilar_parser.add_argument("--subir", action="store_true", help="Sube cada XML insertado a DigitalOcean Spaces.")
+    vigilar_parser.add_argument("--upload-workers", type=int, default=8, help="Subidas concurrentes a Spaces.")
+    vigilar_parser.add_argument("--manifiesto-subidas", default=None,
+                                help="Caché local (SQLite) de objetos subidos, evita consultar Spaces por archivos sin cambios.")
+    vigilar_parser.add_argument("--debounce", type=float, default=2.0,
+                                help="Segundos sin cambios antes de procesar un archivo (evita leer escrituras parciales).")
+    vigilar_parser.add_argument("--polling", action="store_true",
+                                help="Usa sondeo en lugar de notificaciones del sistema (p. ej. carpetas de red).")
+    vigilar_parser.add_argument("--intervalo", type=float, default=5.0, help="Segundos entre sondeos.")
+    vigilar_parser.add_argument("--modo", choices=LOAD_MODES, default="skip",
+                                help="skip (por defecto): omite los CUF que ya están en factura_siat, "
+                                     "upsert: actualiza los existentes (requiere UNIQUE en cuf), insert: INSERT simple.")
+    vigilar_parser.set_defaults(func=cmd_vigilar)
+
+    outbox_parser = subparsers.add_parser("outbox", help="Cola local de pasos pendientes (inserción y subida) con reintentos.")
+    outbox_parser.add_argument("accion", choices=["encolar", "drenar", "estado", "reintentar-muertos"],
+                               help="encolar: agrega las facturas de un manifiesto, drenar: ejecuta los pasos pendientes, "
+                                    "estado: muestra los contadores y la cola de muertos, "
+                                    "reintentar-muertos: devuelve los trabajos muertos a la cola.")
+    outbox_parser.add_argument("--outbox", default="outbox.sqlite", help="Archivo del outbox (SQLite).")
+    outbox_parser.add_argument("--config", default="db_config.ini", help="Archivo de configuración.")
+    outbox_parser.add_argument("--manifiesto", default=None, help="Con encolar: manifiesto CSV/JSONL de facturas.")
+    outbox_parser.add_argument("--base-path", default=".", help="Con encolar: directorio raíz de los archivos XML.")
+    outbox_parser.add_argument("--index", default=None, help="Con encolar: índice de CUFs a usar para las búsquedas.")
+    outbox_parser.add_argument("--subir", action="store_true", help="Con encolar: encola también la subida a Spaces.")
+    outbox_parser.add_argument("--sin-esperar", action="store_true",
+                               help="Con drenar: termina cuando no quedan trabajos vencidos en lugar de esperar los reintentos.")
+    outbox_parser.add_argument("--max-intentos", type=int, default=8, help="Intentos antes de pasar un trabajo a la cola de muertos.")
+    outbox_parser.add_argument("--batch-size", type=int, default=500, help="Inserciones por grupo.")
+    outbox_parser.add_argument("--upload-workers", type=int, default=8, help="Subidas concurrentes a Spaces.")
+    outbox_parser.add_argument("--manifiesto-subidas", default=None,
+                               help="Caché local (SQLite) de objetos subidos, evita consultar Spaces por archivos sin cambios.")
+    outbox_parser.add_argument("--modo", choices=LOAD_MODES, default="skip",
+                               help="skip (por defecto): un reintento no duplica el CUF, upsert: actualiza los existentes, "
+                                    "insert: INSERT simple.")
+    outbox_parser.set_defaults(func=cmd_outbox)
+
+    exportar_parser = subparsers.add_parser("exportar",
+                                            help="Exporta las cabeceras de los XML a Parquet, CSV (gzip) o TSV en lugar de insertarlas.")
+    exportar_parser.add_argument("salida", help="Directorio de salida.")
+    exportar_parser.add_argument("--base-path", default=".", help="Directorio raíz de los archivos XML.")
+    exportar_parser.add_argument("--formato", choices=["parquet", "csv", "tsv"], default="parquet",
+                                 help="parquet (requiere pyarrow) y csv se particionan por mes de fechaEmision y "
+                                      "codigoSucursal; tsv genera un único archivo para LOAD DATA LOCAL INFILE.")
+    exportar_parser.add_argument("--row-group-size", type=int, default=50_000, help="Filas por grupo en Parquet.")
+    exportar_parser.add_argument("--manifiesto", default=None,
+                                 help="Manifiesto CSV/JSONL opcional: exporta solo sus CUFs, con factura_id y pedido.")
+    exportar_parser.add_argument("--prefijo", default="part-0",
+                                 help="Nombre de los archivos en cada partición (uno distinto por corrida para no sobrescribir).")
+    exportar_parser.add_argument("--cargar", action="store_true",
+                                 help="Con tsv: carga el archivo en factura_siat con LOAD DATA LOCAL INFILE.")
+    exportar_parser.add_argument("--config", default="db_config.ini", help="Con --cargar: archivo de configuración.")
+    exportar_parser.set_defaults(func=cmd_exportar)
+
+    salud_parser = subparsers.add_parser("salud", help="Comprueba la conexión a MySQL (SELECT 1) y a Spaces (HEAD del bucket).")
+    salud_parser.add_argument("--solo", choices=["database", "spaces"], default=None,
+                              help="Ejecuta solo ese chequeo (por defecto, ambos).")
+    salud_parser.add_argument("--config", default="db_config.ini", help="Archivo de configuración.")
+    salud_parser.add_argument("--timeout-conexion", type=float, default=3.0, help="Segundos para establecer cada conexión.")
+    salud_parser.add_argument("--timeout-lectura", type=float, default=5.0, help="Segundos para esperar cada respuesta.")
+    salud_parser.add_argument("--json", action="store_true", help="Imprime el resultado como JSON.")
+    salud_parser.set_defaults(func=cmd_salud)
+
+    reconciliar_parser = subparsers.add_parser("reconciliar",
+                                               help="Compara los CUF del disco, de factura_siat y de Spaces.")
+    reconciliar_parser.add_argument("--base-path", default=".", help="Directorio raíz de los archivos XML.")
+    reconciliar_parser.add_argument("--config", default="db_config.ini", help="Archivo de configuración.")
+    reconciliar_parser.add_argument("--index", default=DEFAULT_INDEX_FILE,
+                                    help="Índice de CUFs del que se leen los XML (se actualiza antes de comparar).")
+    reconciliar_parser.add_argument("--salida", default="reconciliacion.jsonl", help="Diferencias encontradas (JSONL).")
+    reconciliar_parser.add_argument("--sin-spaces", action="store_true", help="No compara con el bucket de Spaces.")
+    reconciliar_parser.add_argument("--montos", action="store_true",
+                                    help="Compara también el montoTotal de cada XML con el de factura_siat (lee los XML).")
+    reconciliar_parser.add_argument("--sin-actualizar-indice", action="store_true",
+                                    help="Usa el índice tal como está, sin recorrer el árbol.")
+    reconciliar_parser.add_argument("--page-size", type=int, default=10_000, help="Filas por consulta a factura_siat.")
+    reconciliar_parser.add_argument("--workers", type=int, default=None,
+                                    help="Procesos que leen los montos (por defecto, uno por núcleo).")
+    reconciliar_parser.set_defaults(func=cmd_reconciliar)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+    try:
+        if args.perfil:
+            return profile_run(args.func, args, output_path=args.perfil)
+        return args.func(args)
+    finally:
+        if args.metricas:
+            metrics.write(args.metricas)
 
 
 if __name__ == "__main__":
-    main()
+    raise SystemExit(main())
@@ -0,0 +1,234 @@
+import asyncio
+import logging
+from contextlib import nullcontext
+
+import aiomysql
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from botocore.exceptions import ClientError
+
+from .batch import (
+    STATUS_DB_ERROR,
+    STATUS_NOT_FOUND,
+    STATUS_OK,
+    STATUS_PARSE_ERROR,
+    STATUS_UPLOAD_ERROR,
+    STATUS_VALIDATION_MISMATCH,
+    _escribir_resultado,
+    load_report,
+    read_manifest,
+)
+from .metrics import metrics
+from .spaces import UPLOAD_COUNTERS, UPLOAD_FAILED, UPLOAD_SKIPPED, UPLOAD_UPLOADED, get_spaces_key, hash_file
+from .xml_to_sql import (
+    INSERT_FACTURA_SIAT_SQL,
+    LOAD_MODE_INSERT,
+    LOAD_MODE_SKIP,
+    LOAD_MODE_UPSERT,
+    LOAD_MODES,
+    UPSERT_FACTURA_SIAT_SQL,
+    extract_factura_from_file,
+    find_xml_by_cuf,
+    get_db_config,
+    get_spaces_config,
+    validate_factura,
+)
+
+logger = logging.getLogger(__name__)
+
+def _aiomysql_config(db_config):
+    """Adapts a [DATABASE] section (mysql.connector keywords) to aiomysql.create_pool keywords."""
+    config = dict(db_config)
+    if "database" in config:
+        config["db"] = config.pop("database")
+    if "port" in config:
+        config["port"] = int(config["port"])
+    return config
+
+def _preparar(row, base_path, index_path):
+    """
+    Blocking part of one invoice (lookup, parse and validation), run in a worker thread.
+    Returns (report_record, db_row); db_row is None when the record already has a status.
+    """
+    result = {"cuf": row["cuf"], "factura_id": row["factura_id"], "status": None,
+              "detail": None, "xml_path": None, "db": False, "upload": False}
+    xml_path = find_xml_by_cuf(row["cuf"], base_path, index_path)
+    if not xml_path:
+        result["status"] = STATUS_NOT_FOUND
+        return result, None
+    result["xml_path"] = xml_path
+    try:
+        factura = extract_factura_from_file(xml_path)
+        error_validacion = validate_factura(factura, row["numero_factura"], row["total_factura"])
+        if error_validacion:
+            result["status"] = STATUS_VALIDATION_MISMATCH
+            result["detail"] = error_validacion
+            return result, None
+        return result, factura.to_row(row["factura_id"], row["pedido"])
+    except Exception as e:
+        result["status"] = STATUS_PARSE_ERROR
+        result["detail"] = str(e)
+        return result, None
+
+async def _insertar(pool, db_row, mode):
+    """Inserts one row in its own transaction. Returns False if skip mode found the CUF already loaded."""
+    with metrics.timer("insert_async"):
+        async with pool.acquire() as cnx:
+            async with cnx.cursor() as cursor:
+                try:
+                    if mode == LOAD_MODE_SKIP:
+                        await cursor.execute("SELECT 1 FROM factura_siat WHERE cuf = %s LIMIT 1", (db_row[1],))
+                        if await cursor.fetchone():
+                            return False
+                    await cursor.execute(UPSERT_FACTURA_SIAT_SQL if mode == LOAD_MODE_UPSERT
+                                         else INSERT_FACTURA_SIAT_SQL, db_row)
+                    await cnx.commit()
+                except aiomysql.Error:
+                    metrics.incr("insert_failed")
+                    await cnx.rollback()
+                    raise
+    metrics.incr("rows_inserted")
+    return True
+
+async def _subir(client, spaces_config, xml_path, skip_unchanged):
+    """Uploads one XML with PutObject. Returns (status, public_url)."""
+    spaces_file_key = get_spaces_key(spaces_config, xml_path)
+    bucket_name = spaces_config['bucket_name']
+    public_url = f"{spaces_config['endpoint_url']}/{bucket_name}/{spaces_file_key}"
+    with metrics.timer("upload_async"):
+        md5_hex, sha256_hex = await asyncio.to_thread(hash_file, xml_path)
+        status = UPLOAD_UPLOADED
+        if skip_unchanged:
+            try:
+                response = await client.head_object(Bucket=bucket_name, Key=spaces_file_key)
+                if (response.get("Metadata", {}).get("sha256") == sha256_hex
+                        or response.get("ETag", "").strip('"') == md5_hex):
+                    status = UPLOAD_SKIPPED
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") not in ("404", "NoSuchKey", "NotFound"):
+                    raise
+        if status == UPLOAD_UPLOADED:
+            body = await asyncio.to_thread(_read_bytes, xml_path)
+            await client.put_object(Bucket=bucket_name, Key=spaces_file_key, Body=body, ACL='public-read',
+                                    ContentType='application/xml', Metadata={'sha256': sha256_hex})
+    metrics.incr(UPLOAD_COUNTERS[status])
+    return status, public_url
+
+def _read_bytes(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+async def _ya_insertada():
+    return True
+
+async def procesar_factura_async(row, base_path, pool, client, spaces_config, index_path=None,
+                                 mode=LOAD_MODE_INSERT, skip_unchanged=True, ya_insertada=False):
+    """
+    Processes one manifest row: lookup and parse in a worker thread, then the insert into
+    factura_siat and the upload to Spaces run concurrently, so the invoice takes about
+    max(db, upload) instead of their sum. client may be None to skip the upload, and
+    ya_insertada=True (a previous run inserted the row) only retries the upload.
+    Returns the report record (same format as procesar_lote).
+    """
+    with metrics.timer("invoice_async"):
+        result, db_row = await asyncio.to_thread(_preparar, row, base_path, index_path)
+        if result["status"]:
+            return result
+        tasks = [_ya_insertada() if ya_insertada else _insertar(pool, db_row, mode)]
+        if client is not None:
+            tasks.append(_subir(client, spaces_config, result["xml_path"], skip_unchanged))
+        outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+
+    db_outcome = outcomes[0]
+    if isinstance(db_outcome, BaseException):
+        result["status"] = STATUS_DB_ERROR
+        result["detail"] = str(db_outcome)
+        # The upload may already be done; a re-run skips it as unchanged
+        return result
+    result["db"] = True
+    if db_outcome is False:
+        result["db_existing"] = True
+    if client is not None:
+        upload_outcome = outcomes[1]
+        if isinstance(upload_outcome, BaseException):
+            logger.error("Error subiendo '%s' a Spaces: %s", result["xml_path"], upload_outcome)
+            metrics.incr(UPLOAD_COUNTERS[UPLOAD_FAILED])
+            result["status"] = STATUS_UPLOAD_ERROR
+            result["detail"] = str(upload_outcome)
+            return result
+        result["upload"], result["detail"] = upload_outcome
+    result["status"] = STATUS_OK
+    return result
+
+async def ingerir_async(manifest_path, base_path, config_file, report_path, subir=True, index_path=None,
+                        max_in_flight=32, pool_size=10, mode=LOAD_MODE_INSERT, skip_unchanged=True):
+    """
+    Servicio de ingesta asíncrono: procesa las facturas de un manifiesto (mismo formato que
+    procesar_lote) con un pool de conexiones aiomysql y un cliente S3 asíncrono (aiobotocore).
+
+    Hasta max_in_flight facturas se procesan a la vez; en cada una, la inserción y la subida a
+    Spaces se ejecutan en paralelo. Cada factura se confirma en su propia transacción y su
+    resultado se agrega a report_path, que permite reanudar igual que en procesar_lote (las
+    filas con estado ok se omiten). Si la inserción falla, la subida pudo haberse completado; al
+    reintentar, el XML se omite por no tener cambios. Un error inesperado en una factura se
+    registra como db_error en su línea del reporte y no detiene las demás.
+    Devuelve un dict {estado: cantidad}.
+    """
+    if mode not in LOAD_MODES:
+        raise ValueError(f"Modo de carga desconocido: {mode}")
+    previous_results = load_report(report_path)
+    spaces_config = get_spaces_config(config_file) if subir else None
+    summary = {}
+    semaphore = asyncio.Semaphore(max_in_flight)
+    pool = await aiomysql.create_pool(minsize=1, maxsize=pool_size, **_aiomysql_config(get_db_config(config_file)))
+    try:
+        async with _spaces_client(spaces_config, max_in_flight) as client:
+            with open(report_path, 'a', encoding='utf-8') as report:
+
+                async def procesar(row, ya_insertada):
+                    try:
+                        result = await procesar_factura_async(row, base_path, pool, client, spaces_config,
+                                                              index_path, mode, skip_unchanged, ya_insertada)
+                    except Exception as e:
+                        # Every manifest row gets a report line, so a resume retries it
+                        logger.error("Error procesando la factura '%s': %s", row["cuf"], e)
+                        result = {"cuf": row["cuf"], "factura_id": row["factura_id"], "status": STATUS_DB_ERROR,
+                                  "detail": str(e), "xml_path": None, "db": ya_insertada, "upload": False}
+                    finally:
+                        semaphore.release()
+                    _escribir_resultado(report, result, summary)
+
+                tasks = set()
+                for row in read_manifest(manifest_path):
+                    previous = previous_results.get(row["cuf"])
+                    if previous and previous.get("status") == STATUS_OK:
+                        summary["skipped"] = summary.get("skipped", 0) + 1
+                        continue
+                    # Wait for a free slot before creating the task, so memory stays bounded
+                    await semaphore.acquire()
+                    task = asyncio.create_task(procesar(row, bool(previous and previous.get("db"))))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                if tasks:
+                    await asyncio.gather(*tasks)
+    finally:
+        pool.close()
+        await pool.wait_closed()
+    return summary
+
+def _spaces_client(spaces_config, max_pool_connections):
+    """Async context manager yielding an aiobotocore S3 client, or None when spaces_config is None."""
+    if spaces_config is None:
+        return nullcontext()
+    return get_session().create_client(
+        's3',
+        region_name=spaces_config['region_name'],
+        endpoint_url=spaces_config['endpoint_url'],
+        aws_access_key_id=spaces_config['aws_access_key_id'],
+        aws_secret_access_key=spaces_config['aws_secret_access_key'],
+        config=AioConfig(max_pool_connections=max_pool_connections,
+                         retries={"max_attempts": 5, "mode": "standard"}))
+
+def run_ingerir_async(*args, **kwargs):
+    """Synchronous entry point for ingerir_async (runs its own event loop)."""
+    return asyncio.run(ingerir_async(*args, **kwargs))
@@ -0,0 +1,260 @@
+import csv
+import json
+import logging
+import os
+
+from .spaces import UPLOAD_FAILED, UPLOAD_SKIPPED, SpacesUploader
+from .xml_to_sql import (
+    LOAD_MODE_INSERT,
+    LOAD_MODE_SKIP,
+    extract_factura_from_file,
+    fetch_existing_cufs,
+    find_xml_by_cuf,
+    get_db_config,
+    get_db_pool,
+    get_spaces_config,
+    insert_rows,
+    validate_factura,
+)
+
+logger = logging.getLogger(__name__)
+
+# Estados posibles de una fila en el reporte del lote
+STATUS_OK = "ok"
+STATUS_NOT_FOUND = "not_found"
+STATUS_VALIDATION_MISMATCH = "validation_mismatch"
+STATUS_PARSE_ERROR = "parse_error"
+STATUS_DB_ERROR = "db_error"
+STATUS_UPLOAD_ERROR = "upload_error"
+
+MANIFEST_FIELDS = ("cuf", "factura_id", "pedido", "numero_factura", "total_factura")
+
+def _normalize_manifest_row(raw):
+    """Converts a raw manifest row (CSV or JSONL) to typed values; empty fields become None."""
+    row = {}
+    for field in MANIFEST_FIELDS:
+        value = raw.get(field)
+        if isinstance(value, str):
+            value = value.strip()
+        row[field] = None if value in ("", None) else value
+    if not row["cuf"]:
+        raise ValueError(f"Fila del manifiesto sin CUF: {raw}")
+    if row["factura_id"] is None:
+        raise ValueError(f"Fila del manifiesto sin factura_id para el CUF {row['cuf']}")
+    row["factura_id"] = int(row["factura_id"])
+    if row["numero_factura"] is not None:
+        row["numero_factura"] = str(row["numero_factura"])
+    if row["total_factura"] is not None:
+        row["total_factura"] = float(row["total_factura"])
+    return row
+
+def read_manifest(manifest_path):
+    """
+    Yields manifest rows as dicts with the keys in MANIFEST_FIELDS.
+    Files ending in .jsonl are read as JSON lines, anything else as CSV with a header row.
+    """
+    with open(manifest_path, 'r', encoding='utf-8', newline='') as file:
+        if manifest_path.lower().endswith(".jsonl"):
+            for line in file:
+                line = line.strip()
+                if line:
+                    yield _normalize_manifest_row(json.loads(line))
+        else:
+            for raw in csv.DictReader(file):
+                yield _normalize_manifest_row(raw)
+
+def load_report(report_path):
+    """
+    Reads a previous batch report and returns {cuf: last_result}.
+    Truncated lines (e.g. from a crash while writing) are ignored.
+    """
+    results = {}
+    if not os.path.exists(report_path):
+        return results
+    with open(report_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            results[result["cuf"]] = result
+    return results
+
+def _preparar_fila(row, base_path, index_path, previous):
+    """
+    Runs one manifest row through lookup and validation.
+    Returns (report_record, db_row). A record without status is pending: db_row holds the
+    values to insert, or is None when a previous run already inserted the row.
+    """
+    result = {"cuf": row["cuf"], "factura_id": row["factura_id"], "status": None,
+              "detail": None, "xml_path": None, "db": False, "upload": False}
+    if previous and previous.get("db"):
+        # Crash or upload failure after the insert: do not insert the row again
+        result["db"] = True
+
+    xml_path = find_xml_by_cuf(row["cuf"], base_path, index_path)
+    if not xml_path:
+        result["status"] = STATUS_NOT_FOUND
+        return result, None
+    result["xml_path"] = xml_path
+    if result["db"]:
+        return result, None
+
+    try:
+        factura = extract_factura_from_file(xml_path)
+        error_validacion = validate_factura(factura, row["numero_factura"], row["total_factura"])
+        if error_validacion:
+            result["status"] = STATUS_VALIDATION_MISMATCH
+            result["detail"] = error_validacion
+            return result, None
+        return result, factura.to_row(row["factura_id"], row["pedido"])
+    except Exception as e:
+        result["status"] = STATUS_PARSE_ERROR
+        result["detail"] = str(e)
+        return result, None
+
+def _insertar_pendientes(cnx, pending, batch_size, commit_interval, mode):
+    """
+    Inserts the pending rows as one transaction. If the group fails, the rows are retried one
+    by one so only the offending rows are reported as db_error.
+    In skip mode the CUFs already in factura_siat are fetched for the whole group with one query
+    and those rows are marked as done without inserting them.
+    """
+    import mysql.connector
+
+    to_insert = [(result, db_row) for result, db_row in pending if not result["db"]]
+    if not to_insert:
+        return
+    group_mode = mode
+    if mode == LOAD_MODE_SKIP:
+        try:
+            existing = fetch_existing_cufs(cnx, [result["cuf"] for result, _ in to_insert])
+        except mysql.connector.Error as err:
+            logger.error("Error consultando los CUF existentes: %s", err)
+            existing = set()
+        for result, _ in to_insert:
+            if result["cuf"] in existing:
+                result["db"] = True
+                result["db_existing"] = True
+        to_insert = [(result, db_row) for result, db_row in to_insert if not result["db"]]
+        if not to_insert:
+            return
+        # The existing CUFs were already filtered out; skip mode stays on for the row-by-row retry
+        group_mode = LOAD_MODE_INSERT
+    try:
+        insert_rows(cnx, [db_row for _, db_row in to_insert], batch_size, commit_interval, group_mode)
+        for result, _ in to_insert:
+            result["db"] = True
+        return
+    except mysql.connector.Error as err:
+        logger.error("Error insertando un grupo de %s filas, reintentando fila por fila: %s", len(to_insert), err)
+    for result, db_row in to_insert:
+        try:
+            insert_rows(cnx, [db_row], mode=mode)
+            result["db"] = True
+        except mysql.connector.Error as err:
+            result["status"] = STATUS_DB_ERROR
+            result["detail"] = str(err)
+
+def _subir_pendientes(pending, uploader):
+    """Uploads concurrently the XML of every inserted row (if Spaces is configured) and sets the final status."""
+    inserted = [result for result, _ in pending if not result["status"]]
+    if uploader is None:
+        for result in inserted:
+            result["status"] = STATUS_OK
+        return
+    uploads = uploader.upload_many([result["xml_path"] for result in inserted])
+    for result, (_, upload_status, public_url) in zip(inserted, uploads):
+        if upload_status == UPLOAD_FAILED:
+            result["status"] = STATUS_UPLOAD_ERROR
+            continue
+        result["upload"] = upload_status
+        result["detail"] = public_url
+        result["status"] = STATUS_OK
+
+def procesar_lote(manifest_path, base_path, config_file, report_path, subir=False, index_path=None,
+                  batch_size=500, commit_interval=1, upload_workers=8, skip_unchanged=True,
+                  upload_manifest_path=None, mode=LOAD_MODE_INSERT):
+    """
+    Procesa de forma no interactiva todas las facturas de un manifiesto (CSV o JSONL con las
+    columnas cuf, factura_id, pedido, numero_factura, total_factura).
+
+    Las filas válidas se insertan en grupos de batch_size * commit_interval filas, cada grupo en
+    una sola transacción (executemany de batch_size filas, commit al final del grupo), usando una
+    conexión del pool. Si subir es True, los XML de cada grupo se suben en paralelo con
+    upload_workers hilos que comparten un único cliente S3. Con skip_unchanged, los XML cuyo
+    contenido ya está en Spaces no se vuelven a enviar (ver SpacesUploader); upload_manifest_path
+    es el caché local opcional de objetos subidos que evita incluso el HEAD.
+    mode (insert, upsert o skip) define qué pasa con los CUF que ya están en factura_siat; con
+    upsert o skip, volver a ejecutar un lote sin reporte cuesta aproximadamente lo mismo que las
+    filas nuevas.
+    Cada fila se escribe como una línea JSON en report_path con su estado
+    (ok, not_found, validation_mismatch, parse_error, db_error, upload_error) una vez que su grupo
+    fue confirmado; las insertadas se registran además con "db": true antes de la subida. Al
+    volver a ejecutar con el mismo reporte, las filas con estado ok se omiten y las que ya se
+    insertaron pero fallaron en la subida solo reintentan la subida.
+    Devuelve un dict {estado: cantidad}, o None si no se pudo conectar a la base de datos.
+    """
+    import mysql.connector
+
+    previous_results = load_report(report_path)
+    uploader = None
+    if subir:
+        uploader = SpacesUploader(get_spaces_config(config_file), max_workers=upload_workers,
+                                  skip_unchanged=skip_unchanged, manifest_path=upload_manifest_path)
+    try:
+        cnx = get_db_pool(get_db_config(config_file)).get_connection()
+    except mysql.connector.Error as err:
+        logger.error("No se pudo establecer la conexión con la base de datos. Lote cancelado: %s", err)
+        return None
+
+    summary = {}
+    group_size = batch_size * commit_interval
+    pending = []
+
+    def flush(report):
+        to_insert = [result for result, _ in pending if not result["db"]]
+        _insertar_pendientes(cnx, pending, batch_size, commit_interval, mode)
+        # The group is committed: record it before uploading, so a crash during the upload
+        # does not insert these rows again when the batch is resumed
+        for result in to_insert:
+            if result["db"]:
+                _escribir_progreso(report, result)
+        _subir_pendientes(pending, uploader)
+        for result, _ in pending:
+            _escribir_resultado(report, result, summary)
+        pending.clear()
+
+    try:
+        with open(report_path, 'a', encoding='utf-8') as report:
+            for row in read_manifest(manifest_path):
+                previous = previous_results.get(row["cuf"])
+                if previous and previous.get("status") == STATUS_OK:
+                    summary["skipped"] = summary.get("skipped", 0) + 1
+                    continue
+                result, db_row = _preparar_fila(row, base_path, index_path, previous)
+                if result["status"]:
+                    _escribir_resultado(report, result, summary)
+                    continue
+                pending.append((result, db_row))
+                if len(pending) >= group_size:
+                    flush(report)
+            flush(report)
+    finally:
+        cnx.close()
+    return summary
+
+def _escribir_progreso(report, result):
+    """Appends an intermediate record (no final status yet) that load_report uses on resume."""
+    report.write(json.dumps(result, ensure_ascii=False) + "\n")
+    report.flush()
+
+def _escribir_resultado(report, result, summary):
+    """Appends a row result to the report and counts it in the summary."""
+    report.write(json.dumps(result, ensure_ascii=False) + "\n")
+    report.flush()
+    summary[result["status"]] = summary.get(result["status"], 0) + 1
+    if result.get("db_existing"):
+        summary["db_existing"] = summary.get("db_existing", 0) + 1
+    if result["upload"] == UPLOAD_SKIPPED:
+        summary["upload_skipped"] = summary.get("upload_skipped", 0) + 1
@@ -0,0 +1,185 @@
+import os
+import sqlite3
+
+DEFAULT_INDEX_FILE = "cuf_index.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs(parent);
+CREATE TABLE IF NOT EXISTS files (
+    cuf TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files(dir);
+"""
+
+def open_cuf_index(index_path, base_path):
+    """
+    Opens (creating it if needed) the CUF index for base_path.
+    If the index was built for a different base_path it is emptied so it gets rebuilt.
+    """
+    base = os.path.abspath(base_path)
+    conn = sqlite3.connect(index_path)
+    conn.executescript(_SCHEMA)
+    row = conn.execute("SELECT value FROM meta WHERE key = 'base_path'").fetchone()
+    if row is None or row[0] != base:
+        with conn:
+            conn.execute("DELETE FROM dirs")
+            conn.execute("DELETE FROM files")
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('base_path', ?)", (base,))
+    return conn
+
+def _remove_dir_tree(conn, dir_path):
+    """Removes a directory and everything indexed below it."""
+    prefix = dir_path + os.sep
+    conn.execute("DELETE FROM files WHERE dir = ? OR substr(dir, 1, ?) = ?", (dir_path, len(prefix), prefix))
+    conn.execute("DELETE FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?", (dir_path, len(prefix), prefix))
+
+def _scan_dir(dir_path):
+    """Lists a directory once, returning (subdirs, xml_files) with xml_files as (cuf, path, mtime_ns, size)."""
+    subdirs = []
+    xml_files = []
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.name.endswith(".xml") and entry.is_file():
+                st = entry.stat()
+                xml_files.append((entry.name[:-4], entry.path, st.st_mtime_ns, st.st_size))
+    return subdirs, xml_files
+
+def update_cuf_index(index_path, base_path="."):
+    """
+    Incrementally updates the CUF index.
+    Only directories whose mtime changed since the last run are listed again;
+    unchanged directories cost a single stat() call.
+    Returns a dict with scan statistics.
+    """
+    base = os.path.abspath(base_path)
+    stats = {"dirs_scanned": 0, "dirs_skipped": 0, "dirs_removed": 0, "files_indexed": 0}
+    conn = open_cuf_index(index_path, base)
+    try:
+        with conn:
+            stack = [(base, None)]
+            while stack:
+                dir_path, parent = stack.pop()
+                try:
+                    mtime_ns = os.stat(dir_path).st_mtime_ns
+                except OSError:
+                    _remove_dir_tree(conn, dir_path)
+                    stats["dirs_removed"] += 1
+                    continue
+
+                row = conn.execute("SELECT mtime_ns FROM dirs WHERE path = ?", (dir_path,)).fetchone()
+                known_children = [r[0] for r in conn.execute("SELECT path FROM dirs WHERE parent = ?", (dir_path,))]
+                if row is not None and row[0] == mtime_ns:
+                    stats["dirs_skipped"] += 1
+                    stack.extend((child, dir_path) for child in known_children)
+                    continue
+
+                subdirs, xml_files = _scan_dir(dir_path)
+                stats["dirs_scanned"] += 1
+                stats["files_indexed"] += len(xml_files)
+                conn.execute("DELETE FROM files WHERE dir = ?", (dir_path,))
+                conn.executemany(
+                    "INSERT OR REPLACE INTO files (cuf, path, dir, mtime_ns, size) VALUES (?, ?, ?, ?, ?)",
+                    [(cuf, path, dir_path, file_mtime, size) for cuf, path, file_mtime, size in xml_files]
+                )
+                for gone in set(known_children) - set(subdirs):
+                    _remove_dir_tree(conn, gone)
+                    stats["dirs_removed"] += 1
+                conn.execute(
+                    "INSERT OR REPLACE INTO dirs (path, parent, mtime_ns) VALUES (?, ?, ?)",
+                    (dir_path, parent, mtime_ns)
+                )
+                stack.extend((child, dir_path) for child in subdirs)
+    finally:
+        conn.close()
+    return stats
+
+def build_cuf_index(index_path, base_path="."):
+    """Rebuilds the CUF index from scratch."""
+    conn = open_cuf_index(index_path, base_path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM dirs")
+            conn.execute("DELETE FROM files")
+    finally:
+        conn.close()
+    return update_cuf_index(index_path, base_path)
+
+def lookup_cuf(index_path, cuf, base_path="."):
+    """
+    Looks up the XML path for a CUF in the index without touching the file tree.
+    Returns the path if indexed, None otherwise.
+    """
+    conn = open_cuf_index(index_path, base_path)
+    try:
+        row = conn.execute("SELECT path FROM files WHERE cuf = ?", (cuf,)).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+def iter_indexed_cufs(index_path, base_path="."):
+    """
+    Yields (cuf, path) for every indexed file in ascending CUF order, streaming from the
+    primary key so memory does not depend on the number of files.
+    """
+    conn = open_cuf_index(index_path, base_path)
+    try:
+        yield from conn.execute("SELECT cuf, path FROM files ORDER BY cuf")
+    finally:
+        conn.close()
+
+def find_xml_in_index(cuf, base_path=".", index_path=DEFAULT_INDEX_FILE):
+    """
+    Finds the XML path for a CUF using the index.
+    On a miss (or a stale entry) the index is updated incrementally and the lookup retried once.
+    """
+    xml_path = lookup_cuf(index_path, cuf, base_path)
+    if xml_path and os.path.isfile(xml_path):
+        return xml_path
+    update_cuf_index(index_path, base_path)
+    xml_path = lookup_cuf(index_path, cuf, base_path)
+    return xml_path if xml_path and os.path.isfile(xml_path) else None
+
+def verify_cuf_index(index_path, base_path=".", repair=False):
+    """
+    Checks every indexed file against the file system.
+    Returns a dict with the total of indexed files and the CUFs whose file is missing or changed (mtime/size).
+    With repair=True the directories holding those files are marked stale and the index is updated.
+    """
+    conn = open_cuf_index(index_path, base_path)
+    result = {"indexed": 0, "missing": [], "changed": []}
+    stale_dirs = set()
+    try:
+        for cuf, path, dir_path, mtime_ns, size in conn.execute("SELECT cuf, path, dir, mtime_ns, size FROM files"):
+            result["indexed"] += 1
+            try:
+                st = os.stat(path)
+            except OSError:
+                result["missing"].append(cuf)
+                stale_dirs.add(dir_path)
+                continue
+            if st.st_mtime_ns != mtime_ns or st.st_size != size:
+                result["changed"].append(cuf)
+                stale_dirs.add(dir_path)
+        if repair and stale_dirs:
+            with conn:
+                conn.executemany("UPDATE dirs SET mtime_ns = -1 WHERE path = ?", [(d,) for d in stale_dirs])
+    finally:
+        conn.close()
+    if repair and stale_dirs:
+        update_cuf_index(index_path, base_path)
+    return result
@@ -0,0 +1,282 @@
+import csv
+import gzip
+import logging
+import os
+from collections import OrderedDict
+from decimal import Decimal
+from operator import itemgetter
+
+from .batch import read_manifest
+from .ingest import iter_xml_files
+from .metrics import metrics
+from .xml_to_sql import FACTURA_SIAT_COLUMNS, FACTURA_SIAT_FIELDS, extract_factura_from_file, get_db_config
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+logger = logging.getLogger(__name__)
+
+# Formatos de exportación
+EXPORT_PARQUET = "parquet"
+EXPORT_CSV = "csv"
+EXPORT_TSV = "tsv"
+EXPORT_FORMATS = (EXPORT_PARQUET, EXPORT_CSV, EXPORT_TSV)
+
+_FECHA_INDEX = FACTURA_SIAT_COLUMNS.index("fechaEmision")
+_SUCURSAL_INDEX = FACTURA_SIAT_COLUMNS.index("codigoSucursal")
+
+# Columns stored in the partitioned files: codigoSucursal is encoded in the directory name
+# (hive convention), so readers get it back from the partitioning instead of the file
+PARTITION_COLUMNS = ("codigoSucursal",)
+FILE_COLUMNS = tuple(column for column in FACTURA_SIAT_COLUMNS if column not in PARTITION_COLUMNS)
+_file_values = itemgetter(*(FACTURA_SIAT_COLUMNS.index(column) for column in FILE_COLUMNS))
+
+def partition_path(row):
+    """Hive-style partition directory of a factura_siat row: mes=YYYY-MM/codigoSucursal=N."""
+    return os.path.join(f"mes={row[_FECHA_INDEX][:7]}", f"codigoSucursal={row[_SUCURSAL_INDEX]}")
+
+def arrow_schema():
+    """pyarrow schema of FILE_COLUMNS, with the types of FACTURA_SIAT_FIELDS."""
+    types = {int: pa.int64(), Decimal: pa.decimal128(24, 6), str: pa.string()}
+    return pa.schema([(field.name, types[field.type]) for field in FACTURA_SIAT_FIELDS
+                      if field.column and field.name in FILE_COLUMNS])
+
+class _PartFiles:
+    """
+    Open part files of a partitioned sink, at most max_open at a time: the least recently used
+    one is closed to open another. A partition written again after its file was closed gets a
+    new part file (part-0.parquet, then part-0-1.parquet, part-0-2.parquet...).
+    open_part(path) creates a part file and returns an object with a close() method.
+    """
+
+    def __init__(self, output_dir, file_name, open_part, max_open):
+        self.output_dir = output_dir
+        self.file_name = file_name
+        self._stem, self._dot, self._extension = file_name.partition(".")
+        self._open_part = open_part
+        self.max_open = max(1, max_open)
+        self._open = OrderedDict()
+        # partition -> number of part files created
+        self._counts = {}
+
+    def get(self, partition):
+        part = self._open.get(partition)
+        if part is not None:
+            self._open.move_to_end(partition)
+            return part
+        if len(self._open) >= self.max_open:
+            _, evicted = self._open.popitem(last=False)
+            evicted.close()
+        count = self._counts.get(partition, 0)
+        self._counts[partition] = count + 1
+        name = self.file_name if count == 0 else f"{self._stem}-{count}{self._dot}{self._extension}"
+        directory = os.path.join(self.output_dir, partition)
+        os.makedirs(directory, exist_ok=True)
+        part = self._open_part(os.path.join(directory, name))
+        self._open[partition] = part
+        return part
+
+    def close(self):
+        """Closes the open part files and returns the number of partitions written."""
+        for part in self._open.values():
+            part.close()
+        self._open.clear()
+        return len(self._counts)
+
+class ParquetSink:
+    """
+    Writes rows into Parquet files per partition, without the partition columns (see
+    FILE_COLUMNS) so the output reads back as a hive-partitioned dataset.
+    Rows are buffered per partition and written as a row group when a partition reaches
+    row_group_size rows or, when all the buffers together hold more than max_buffered_rows
+    rows, the largest buffer is written; memory is therefore bounded by max_buffered_rows rows
+    plus at most max_open_files open writers, whatever the input size and number of partitions.
+    """
+
+    def __init__(self, output_dir, row_group_size=50_000, file_name="part-0.parquet",
+                 max_buffered_rows=200_000, max_open_files=64):
+        if pa is None:
+            raise RuntimeError("pyarrow no está instalado; instálelo (extra 'parquet') o use el formato csv.")
+        self.row_group_size = row_group_size
+        self.max_buffered_rows = max_buffered_rows
+        self.schema = arrow_schema()
+        self._files = _PartFiles(output_dir, file_name, lambda path: pq.ParquetWriter(path, self.schema),
+                                 max_open_files)
+        self._buffers = {}
+        self._buffered = 0
+
+    def write(self, row):
+        partition = partition_path(row)
+        buffer = self._buffers.setdefault(partition, [])
+        buffer.append(_file_values(row))
+        self._buffered += 1
+        if len(buffer) >= self.row_group_size:
+            self._flush(partition)
+        elif self._buffered > self.max_buffered_rows:
+            self._flush(max(self._buffers, key=lambda key: len(self._buffers[key])))
+
+    def _flush(self, partition):
+        buffer = self._buffers.pop(partition, None)
+        if not buffer:
+            return
+        self._buffered -= len(buffer)
+        columns = [pa.array(values, type=field.type) for values, field in zip(zip(*buffer), self.schema)]
+        self._files.get(partition).write_table(pa.Table.from_arrays(columns, schema=self.schema),
+                                               row_group_size=self.row_group_size)
+
+    def close(self):
+        for partition in list(self._buffers):
+            self._flush(partition)
+        return self._files.close()
+
+class _CsvPart:
+    """One gzip CSV part file with a FILE_COLUMNS header."""
+
+    def __init__(self, path):
+        self._file = gzip.open(path, 'wt', encoding='utf-8', newline='')
+        self.writerow = csv.writer(self._file).writerow
+        self.writerow(FILE_COLUMNS)
+
+    def close(self):
+        self._file.close()
+
+class CsvSink:
+    """
+    Streams rows into gzip CSV files (with a FILE_COLUMNS header) per partition; nothing is
+    buffered and at most max_open_files files are open at a time. As with Parquet,
+    codigoSucursal is only in the directory name.
+    """
+
+    def __init__(self, output_dir, file_name="part-0.csv.gz", max_open_files=64):
+        self._files = _PartFiles(output_dir, file_name, _CsvPart, max_open_files)
+
+    def write(self, row):
+        self._files.get(partition_path(row)).writerow(_file_values(row))
+
+    def close(self):
+        return self._files.close()
+
+def _tsv_value(value):
+    """Renders a value with the default escaping of LOAD DATA (ESCAPED BY '\\'), NULL as \\N."""
+    if value is None:
+        return "\\N"
+    text = str(value)
+    if "\\" in text or "\t" in text or "\n" in text or "\r" in text or "\0" in text:
+        text = (text.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+                .replace("\r", "\\r").replace("\0", "\\0"))
+    return text
+
+class TsvSink:
+    """
+    Streams all rows into a single UTF-8 TSV file ready for LOAD DATA LOCAL INFILE
+    (see load_data_sql); it is not partitioned so it can be loaded with one statement.
+    """
+
+    def __init__(self, output_dir, file_name="factura_siat.tsv"):
+        os.makedirs(output_dir, exist_ok=True)
+        self.path = os.path.join(output_dir, file_name)
+        self._file = open(self.path, 'w', encoding='utf-8', newline='')
+
+    def write(self, row):
+        self._file.write("\t".join(map(_tsv_value, row)) + "\n")
+
+    def close(self):
+        self._file.close()
+        return 1
+
+def load_data_sql(tsv_path):
+    """Returns the LOAD DATA LOCAL INFILE statement that loads a TsvSink file into factura_siat."""
+    path = os.path.abspath(tsv_path).replace("\\", "/").replace("'", "\\'")
+    return (f"LOAD DATA LOCAL INFILE '{path}' INTO TABLE factura_siat CHARACTER SET utf8mb4 "
+            "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' "
+            f"({', '.join(FACTURA_SIAT_COLUMNS)})")
+
+def cargar_tsv(tsv_path, config_file):
+    """
+    Carga un TSV exportado en factura_siat con LOAD DATA LOCAL INFILE (el servidor debe tener
+    local_infile habilitado). Devuelve la cantidad de filas cargadas.
+    """
+    import mysql.connector
+
+    cnx = mysql.connector.connect(**get_db_config(config_file), allow_local_infile=True)
+    try:
+        cursor = cnx.cursor()
+        try:
+            with metrics.timer("load_data"):
+                cursor.execute(load_data_sql(tsv_path))
+                cnx.commit()
+            metrics.incr("rows_inserted", cursor.rowcount)
+            return cursor.rowcount
+        finally:
+            cursor.close()
+    finally:
+        cnx.close()
+
+def iter_rows(base_path, manifest=None, summary=None):
+    """
+    Yields the factura_siat row of every XML under base_path, one file at a time.
+    With a manifest ({cuf: row}) only its CUFs are exported, with their factura_id and pedido;
+    otherwise both are None. Outcomes other than exported rows are counted in summary.
+    """
+    summary = summary if summary is not None else {}
+    for xml_path in iter_xml_files(base_path):
+        summary["files"] = summary.get("files", 0) + 1
+        manifest_row = None
+        if manifest is not None:
+            manifest_row = manifest.get(os.path.basename(xml_path)[:-4])
+            if manifest_row is None:
+                summary["not_in_manifest"] = summary.get("not_in_manifest", 0) + 1
+                continue
+        try:
+            factura = extract_factura_from_file(xml_path)
+            if manifest_row is None:
+                row = factura.to_row(None)
+            else:
+                row = factura.to_row(manifest_row["factura_id"], manifest_row["pedido"])
+        except Exception as e:
+            logger.error("Error procesando el archivo XML '%s': %s", xml_path, e)
+            summary["parse_error"] = summary.get("parse_error", 0) + 1
+            continue
+        yield row
+
+def exportar_directorio(base_path, output_dir, formato=EXPORT_PARQUET, row_group_size=50_000,
+                        manifest_path=None, file_prefix="part-0", max_buffered_rows=200_000, max_open_files=64):
+    """
+    Exporta las cabeceras de todos los XML bajo base_path como archivos en lugar de insertarlas
+    en MySQL, leyendo y escribiendo de a una factura para que la memoria no dependa del tamaño
+    de la entrada.
+
+    formato parquet (requiere pyarrow) y csv (gzip) particionan por mes de fechaEmision y
+    codigoSucursal (output_dir/mes=YYYY-MM/codigoSucursal=N/<file_prefix>.parquet|.csv.gz);
+    parquet escribe grupos de hasta row_group_size filas y retiene en memoria a lo sumo
+    max_buffered_rows filas en total. Quedan abiertos a lo sumo max_open_files archivos; si una
+    partición cerrada vuelve a recibir filas se escriben en un archivo nuevo
+    (<file_prefix>-1.parquet, ...). formato tsv escribe un único output_dir/factura_siat.tsv
+    listo para LOAD DATA LOCAL INFILE (ver cargar_tsv).
+    Un archivo existente con el mismo nombre se sobrescribe; use otro file_prefix para agregar
+    archivos a una partición.
+    Devuelve un dict con files, rows, partitions y los errores por estado.
+    """
+    if formato == EXPORT_PARQUET:
+        sink = ParquetSink(output_dir, row_group_size, f"{file_prefix}.parquet", max_buffered_rows, max_open_files)
+    elif formato == EXPORT_CSV:
+        sink = CsvSink(output_dir, f"{file_prefix}.csv.gz", max_open_files)
+    elif formato == EXPORT_TSV:
+        sink = TsvSink(output_dir)
+    else:
+        raise ValueError(f"Formato de exportación desconocido: {formato}")
+    manifest = None
+    if manifest_path:
+        manifest = {row["cuf"]: row for row in read_manifest(manifest_path)}
+    summary = {"files": 0, "rows": 0}
+    try:
+        for row in iter_rows(base_path, manifest, summary):
+            sink.write(row)
+            summary["rows"] += 1
+    finally:
+        summary["partitions"] = sink.close()
+    metrics.incr("rows_exported", summary["rows"])
+    return summary
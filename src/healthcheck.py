@@ -0,0 +1,160 @@
+import logging
+import os
+import threading
+import time
+
+from .metrics import metrics
+from .spaces import get_spaces_client
+from .xml_to_sql import get_db_config, get_db_pool, get_spaces_config
+
+logger = logging.getLogger(__name__)
+
+# Chequeos disponibles
+CHECK_DATABASE = "database"
+CHECK_SPACES = "spaces"
+CHECKS = (CHECK_DATABASE, CHECK_SPACES)
+
+def probe_database(db_config, connect_timeout=3.0):
+    """
+    Runs SELECT 1 on a connection of a dedicated one-connection pool, reused between the probes
+    with the same db_config and connect_timeout.
+    """
+    cnx = get_db_pool(dict(db_config, connection_timeout=max(1, round(connect_timeout))),
+                      pool_name="siat_healthcheck", pool_size=1).get_connection()
+    try:
+        cursor = cnx.cursor()
+        try:
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+        finally:
+            cursor.close()
+    finally:
+        cnx.close()
+
+def probe_spaces(spaces_config, connect_timeout=3.0, read_timeout=5.0):
+    """HEADs the configured bucket with a client that does not retry."""
+    client = get_spaces_client(spaces_config, max_pool_connections=1, max_attempts=1,
+                               connect_timeout=connect_timeout, read_timeout=read_timeout)
+    client.head_bucket(Bucket=spaces_config['bucket_name'])
+
+def _error_code(error):
+    """MySQL errno, S3 error code, or the exception type name."""
+    if getattr(error, "errno", None):
+        return error.errno
+    response = getattr(error, "response", None)
+    if isinstance(response, dict) and response.get("Error", {}).get("Code"):
+        return response["Error"]["Code"]
+    return type(error).__name__
+
+def _run_probes(probes, timeout):
+    """
+    Runs the probes ({name: callable}) in daemon threads at the same time and waits at most
+    timeout seconds in total, so a hung probe cannot block the caller (its thread is abandoned).
+    Returns {name: result dict}.
+    """
+    outcomes = {}
+
+    def run(name, probe):
+        start = time.perf_counter()
+        try:
+            probe()
+            outcomes[name] = (None, time.perf_counter() - start)
+        except Exception as e:
+            outcomes[name] = (e, time.perf_counter() - start)
+
+    threads = [threading.Thread(target=run, args=(name, probe), daemon=True, name=f"healthcheck-{name}")
+               for name, probe in probes.items()]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.monotonic()))
+
+    results = {}
+    for name in probes:
+        error, elapsed = outcomes.get(name, (TimeoutError(f"Sin respuesta en {timeout} s"), timeout))
+        results[name] = {"name": name, "ok": error is None, "latency_ms": round(elapsed * 1000, 2),
+                         "error": None if error is None else str(error),
+                         "error_code": None if error is None else _error_code(error),
+                         "checked_at": time.time(), "cached": False}
+        metrics.observe(f"healthcheck_{name}", elapsed)
+        if error is not None:
+            metrics.incr(f"healthcheck_{name}_failed")
+    return results
+
+class HealthChecker:
+    """
+    Checks that MySQL and Spaces are reachable: SELECT 1 on a pooled connection and HEAD on the
+    configured bucket, run concurrently with explicit connect and read timeouts.
+
+    Successful results are cached for ttl seconds, so batch jobs and the watcher can call check()
+    before every group at almost no cost; failures are not cached and are probed again on the
+    next call. MySQL read timeouts are enforced by the overall deadline (connect_timeout +
+    read_timeout), since mysql.connector only takes a connect timeout.
+    """
+
+    def __init__(self, config_file="db_config.ini", ttl=30.0, connect_timeout=3.0, read_timeout=5.0):
+        self.config_file = config_file
+        self.ttl = ttl
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._lock = threading.Lock()
+        # name -> (expires_at, result)
+        self._cache = {}
+
+    def _probe(self, name):
+        """Returns the probe callable for name; reading the configuration may raise."""
+        if name == CHECK_DATABASE:
+            db_config = get_db_config(self.config_file)
+            return lambda: probe_database(db_config, self.connect_timeout)
+        if name == CHECK_SPACES:
+            spaces_config = get_spaces_config(self.config_file)
+            return lambda: probe_spaces(spaces_config, self.connect_timeout, self.read_timeout)
+        raise ValueError(f"Chequeo desconocido: {name}")
+
+    def check(self, checks=CHECKS, force=False):
+        """
+        Returns {"ok": bool, "checks": {name: result}}; each result has name, ok, latency_ms,
+        error, error_code, checked_at and cached. force=True ignores the cached results.
+        """
+        with self._lock:
+            now = time.monotonic()
+            results = {}
+            probes = {}
+            for name in checks:
+                cached = None if force else self._cache.get(name)
+                if cached and cached[0] > now:
+                    results[name] = dict(cached[1], cached=True)
+                    continue
+                try:
+                    probes[name] = self._probe(name)
+                except (FileNotFoundError, ValueError, KeyError) as e:
+                    results[name] = {"name": name, "ok": False, "latency_ms": 0.0, "error": str(e),
+                                     "error_code": "config", "checked_at": time.time(), "cached": False}
+            if probes:
+                fresh = _run_probes(probes, self.connect_timeout + self.read_timeout)
+                expires_at = time.monotonic() + self.ttl
+                for name, result in fresh.items():
+                    if result["ok"]:
+                        self._cache[name] = (expires_at, result)
+                    else:
+                        self._cache.pop(name, None)
+                results.update(fresh)
+        return {"ok": all(result["ok"] for result in results.values()),
+                "checks": {name: results[name] for name in checks}}
+
+_checkers = {}
+_checkers_lock = threading.Lock()
+
+def check_health(config_file="db_config.ini", checks=CHECKS, force=False, **kwargs):
+    """
+    Checks MySQL and Spaces with a HealthChecker shared by the calls with the same configuration
+    file and options (ttl, connect_timeout, read_timeout), so its cache is reused.
+    """
+    cache_key = (os.path.abspath(config_file), tuple(sorted(kwargs.items())))
+    with _checkers_lock:
+        checker = _checkers.get(cache_key)
+        if checker is None:
+            checker = HealthChecker(config_file, **kwargs)
+            _checkers[cache_key] = checker
+    return checker.check(checks, force)
@@ -0,0 +1,230 @@
+import logging
+import multiprocessing
+import os
+import queue
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from .batch import (
+    STATUS_DB_ERROR,
+    STATUS_OK,
+    STATUS_PARSE_ERROR,
+    STATUS_VALIDATION_MISMATCH,
+    read_manifest,
+)
+from .metrics import metrics
+from .xml_to_sql import (
+    LOAD_MODE_INSERT,
+    LOAD_MODE_SKIP,
+    extract_factura_from_file,
+    get_db_config,
+    insert_rows,
+    validate_factura,
+)
+
+logger = logging.getLogger(__name__)
+
+STATUS_NOT_IN_MANIFEST = "not_in_manifest"
+STATUS_DB_EXISTING = "db_existing"
+
+# Manifiesto {cuf: fila} cargado una sola vez en cada proceso trabajador
+_worker_manifest = None
+
+def iter_xml_files(base_path):
+    """Walks base_path once, yielding the path of every .xml file."""
+    stack = [base_path]
+    while stack:
+        xml_paths = []
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".xml") and entry.is_file():
+                    xml_paths.append(entry.path)
+        metrics.incr("files_scanned", len(xml_paths))
+        yield from xml_paths
+
+def _iter_chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _init_worker(manifest):
+    global _worker_manifest
+    _worker_manifest = manifest
+
+def _parse_chunk(xml_paths):
+    """
+    Worker: extracts and validates a chunk of XML files.
+    Returns (rows, statuses, metrics_snapshot) where rows are factura_siat tuples ready to
+    insert, statuses maps every non-inserted outcome to its count and metrics_snapshot holds
+    the worker metrics of this chunk.
+    """
+    metrics.reset()
+    rows = []
+    statuses = {}
+    for xml_path in xml_paths:
+        cuf = os.path.basename(xml_path)[:-4]
+        manifest_row = None
+        if _worker_manifest is not None:
+            manifest_row = _worker_manifest.get(cuf)
+            if manifest_row is None:
+                statuses[STATUS_NOT_IN_MANIFEST] = statuses.get(STATUS_NOT_IN_MANIFEST, 0) + 1
+                continue
+        try:
+            factura = extract_factura_from_file(xml_path)
+            if manifest_row is None:
+                rows.append(factura.to_row(None))
+                continue
+            if validate_factura(factura, manifest_row["numero_factura"], manifest_row["total_factura"]):
+                statuses[STATUS_VALIDATION_MISMATCH] = statuses.get(STATUS_VALIDATION_MISMATCH, 0) + 1
+                continue
+            rows.append(factura.to_row(manifest_row["factura_id"], manifest_row["pedido"]))
+        except Exception as e:
+            logger.error("Error procesando el archivo XML '%s': %s", xml_path, e)
+            statuses[STATUS_PARSE_ERROR] = statuses.get(STATUS_PARSE_ERROR, 0) + 1
+    return rows, statuses, metrics.snapshot()
+
+def _db_writer(rows_queue, summary_queue, db_config, batch_size, commit_interval, mode):
+    """
+    Writer process: the only process holding a MySQL connection.
+    Consumes lists of rows from rows_queue until it receives None and inserts them in groups of
+    batch_size * commit_interval rows with the given load mode. A failing group is retried row by row.
+    Sends ({status: count}, metrics_snapshot) through summary_queue when done.
+    """
+    import mysql.connector
+
+    metrics.reset()
+    summary = {STATUS_OK: 0, STATUS_DB_ERROR: 0}
+    if mode == LOAD_MODE_SKIP:
+        summary[STATUS_DB_EXISTING] = 0
+
+    def count(sent, total):
+        summary[STATUS_OK] += sent
+        if mode == LOAD_MODE_SKIP:
+            summary[STATUS_DB_EXISTING] += total - sent
+
+    try:
+        cnx = mysql.connector.connect(**db_config)
+    except mysql.connector.Error as err:
+        logger.error("Error connecting to database: %s", err)
+        cnx = None
+    group_size = batch_size * commit_interval
+    group = []
+
+    def flush():
+        if not group:
+            return
+        if cnx is None:
+            summary[STATUS_DB_ERROR] += len(group)
+        else:
+            try:
+                count(insert_rows(cnx, group, batch_size, commit_interval, mode), len(group))
+            except mysql.connector.Error as err:
+                logger.error("Error insertando un grupo de %s filas, reintentando fila por fila: %s", len(group), err)
+                for row in group:
+                    try:
+                        count(insert_rows(cnx, [row], mode=mode), 1)
+                    except mysql.connector.Error as row_err:
+                        logger.error("Error insertando la factura %s: %s", row[1], row_err)
+                        summary[STATUS_DB_ERROR] += 1
+        group.clear()
+
+    try:
+        # Keep draining the queue even without a connection so the producers never block
+        while True:
+            rows = rows_queue.get()
+            if rows is None:
+                break
+            group.extend(rows)
+            if len(group) >= group_size:
+                flush()
+        flush()
+    finally:
+        if cnx is not None:
+            cnx.close()
+        summary_queue.put((summary, metrics.snapshot()))
+
+def _put(rows_queue, item, writer):
+    """Puts into the bounded queue, failing instead of blocking forever if the writer died."""
+    while True:
+        try:
+            rows_queue.put(item, timeout=1)
+            return
+        except queue.Full:
+            if not writer.is_alive():
+                raise RuntimeError("El proceso escritor de la base de datos terminó inesperadamente.")
+
+def ingerir_directorio(base_path, config_file, workers=None, chunk_size=200, queue_size=8,
+                       batch_size=500, commit_interval=1, manifest_path=None, mode=LOAD_MODE_INSERT):
+    """
+    Ingiere todos los XML bajo base_path usando varios procesos.
+
+    El árbol se recorre una sola vez y los archivos se reparten en bloques de chunk_size entre
+    `workers` procesos (por defecto, uno por núcleo) que extraen y validan las facturas. Las
+    filas resultantes pasan por una cola acotada (queue_size bloques) a un único proceso
+    escritor que las inserta en factura_siat; si la base de datos es más lenta que el parseo,
+    la cola se llena y se deja de enviar trabajo (backpressure).
+
+    Si se indica manifest_path (mismo formato que procesar_lote), solo se insertan los CUF del
+    manifiesto, con su factura_id y pedido, y se validan numero_factura y total_factura.
+    Sin manifiesto, factura_id y pedido quedan en NULL.
+    mode (insert, upsert o skip) se aplica a los CUF que ya existen en factura_siat.
+    Devuelve un dict {estado: cantidad}.
+    """
+    workers = workers or os.cpu_count() or 1
+    manifest = None
+    if manifest_path:
+        manifest = {row["cuf"]: row for row in read_manifest(manifest_path)}
+    db_config = dict(get_db_config(config_file))
+
+    rows_queue = multiprocessing.Queue(maxsize=queue_size)
+    summary_queue = multiprocessing.Queue()
+    writer = multiprocessing.Process(target=_db_writer,
+                                     args=(rows_queue, summary_queue, db_config, batch_size, commit_interval, mode))
+    writer.start()
+
+    summary = {"files": 0}
+    max_in_flight = workers * 2
+    in_flight = set()
+
+    def collect(done):
+        for future in done:
+            rows, statuses, worker_metrics = future.result()
+            metrics.merge(worker_metrics)
+            for status, count in statuses.items():
+                summary[status] = summary.get(status, 0) + count
+            if rows:
+                _put(rows_queue, rows, writer)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(manifest,)) as executor:
+            for chunk in _iter_chunks(iter_xml_files(base_path), chunk_size):
+                summary["files"] += len(chunk)
+                in_flight.add(executor.submit(_parse_chunk, chunk))
+                if len(in_flight) >= max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+            done, in_flight = wait(in_flight)
+            collect(done)
+    finally:
+        if writer.is_alive():
+            _put(rows_queue, None, writer)
+        # Read the writer summary before joining so the child is not blocked flushing the queue
+        writer_summary = {}
+        while writer.is_alive() or not summary_queue.empty():
+            try:
+                writer_summary, writer_metrics = summary_queue.get(timeout=1)
+                metrics.merge(writer_metrics)
+                break
+            except queue.Empty:
+                continue
+        writer.join()
+
+    for status, count in writer_summary.items():
+        summary[status] = summary.get(status, 0) + count
+    return summary
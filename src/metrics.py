@@ -0,0 +1,140 @@
+import cProfile
+import io
+import json
+import logging
+import math
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets, Prometheus style
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, math.inf)
+
+class Metrics:
+    """
+    Thread-safe collection of counters and per-stage latency histograms.
+
+    Stages are timed with `timer(stage)`; counters are increased with `incr(name)`. A snapshot
+    is a plain dict, so metrics gathered in worker processes can be sent back and merged.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._stages = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, stage, seconds):
+        """Records one operation of `stage` that took `seconds`."""
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = {"count": 0, "sum": 0.0, "buckets": [0] * len(self.buckets)}
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+                    break
+
+    @contextmanager
+    def timer(self, stage):
+        """Context manager that records the duration of the enclosed block under `stage`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._stages.clear()
+
+    def snapshot(self):
+        """Returns {"counters": {...}, "stages": {stage: {"count", "sum", "buckets"}}} (bucket counts not cumulative)."""
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "stages": {stage: {"count": h["count"], "sum": h["sum"], "buckets": list(h["buckets"])}
+                           for stage, h in self._stages.items()},
+            }
+
+    def merge(self, snapshot):
+        """Adds a snapshot (e.g. from a worker process) to these metrics."""
+        with self._lock:
+            for name, value in snapshot.get("counters", {}).items():
+                self._counters[name] = self._counters.get(name, 0) + value
+            for stage, other in snapshot.get("stages", {}).items():
+                histogram = self._stages.get(stage)
+                if histogram is None:
+                    histogram = self._stages[stage] = {"count": 0, "sum": 0.0, "buckets": [0] * len(self.buckets)}
+                histogram["count"] += other["count"]
+                histogram["sum"] += other["sum"]
+                histogram["buckets"] = [a + b for a, b in zip(histogram["buckets"], other["buckets"])]
+
+    def write_jsonl(self, path):
+        """Appends the current snapshot as one JSON line, with a timestamp and the bucket bounds."""
+        record = {"timestamp": time.time(), "buckets": [str(b) if math.isinf(b) else b for b in self.buckets]}
+        record.update(self.snapshot())
+        with open(path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(record) + "\n")
+
+    def to_prometheus(self, prefix="siat"):
+        """Renders the metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+        if snapshot["stages"]:
+            metric = f"{prefix}_stage_duration_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for stage, histogram in sorted(snapshot["stages"].items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram["buckets"]):
+                    cumulative += count
+                    le = "+Inf" if math.isinf(bound) else repr(bound)
+                    lines.append(f'{metric}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{stage="{stage}"}} {histogram["sum"]}')
+                lines.append(f'{metric}_count{{stage="{stage}"}} {histogram["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, prefix="siat"):
+        """Writes the metrics as a Prometheus text file (e.g. for node_exporter's textfile collector)."""
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(self.to_prometheus(prefix))
+
+    def write(self, path):
+        """Writes Prometheus text if path ends in .prom, otherwise appends a JSON line."""
+        if path.endswith(".prom"):
+            self.write_prometheus(path)
+        else:
+            self.write_jsonl(path)
+
+# Métricas del proceso actual, compartidas por todo el pipeline
+metrics = Metrics()
+
+def profile_run(func, *args, output_path=None, sort="cumulative", limit=30, **kwargs):
+    """
+    Runs func(*args, **kwargs) under cProfile and returns its result.
+    The raw stats are dumped to output_path (readable with pstats or snakeviz) when given;
+    otherwise the top `limit` entries sorted by `sort` are logged.
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        if output_path:
+            profiler.dump_stats(output_path)
+        else:
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats(sort).print_stats(limit)
+            logger.info("%s", stream.getvalue())
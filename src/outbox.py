@@ -0,0 +1,293 @@
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+
+from .batch import read_manifest
+from .metrics import metrics
+from .spaces import UPLOAD_FAILED, SpacesUploader
+from .xml_to_sql import (
+    LOAD_MODE_SKIP,
+    extract_factura_from_file,
+    find_xml_by_cuf,
+    get_db_config,
+    get_db_pool,
+    get_spaces_config,
+    insert_rows,
+    validate_factura,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTBOX_FILE = "outbox.sqlite"
+
+# Pasos de cada factura
+STEP_DB = "db"
+STEP_UPLOAD = "upload"
+STEPS = (STEP_DB, STEP_UPLOAD)
+
+# Estados de un trabajo
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_DEAD = "dead"
+
+class Outbox:
+    """
+    Durable local job queue (SQLite) with one job per invoice and step (insert into
+    factura_siat, upload to Spaces), so each step is retried on its own.
+
+    Jobs are claimed with a lease: a job left running by a crashed worker becomes due again
+    when its lease expires. A failed job is retried with exponential backoff and jitter and
+    moved to the dead letters after max_attempts; dead jobs stay in the table until retried
+    with retry_dead.
+    """
+
+    def __init__(self, outbox_path=DEFAULT_OUTBOX_FILE, max_attempts=8, backoff_base=5.0, backoff_max=600.0,
+                 lease=300.0):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(outbox_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                cuf TEXT NOT NULL,
+                step TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                updated_at REAL NOT NULL,
+                UNIQUE (cuf, step)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (step, status, next_attempt_at)")
+
+    def enqueue(self, cuf, xml_path, factura_id=None, pedido=None, steps=STEPS):
+        """
+        Records the pending steps of an invoice in one transaction. A step already queued for
+        the CUF is reset to pending with the new payload (e.g. after the XML was corrected).
+        """
+        payload = json.dumps({"xml_path": xml_path, "factura_id": factura_id, "pedido": pedido})
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany("""
+                INSERT INTO jobs (cuf, step, payload, status, attempts, next_attempt_at, updated_at)
+                VALUES (?, ?, ?, ?, 0, ?, ?)
+                ON CONFLICT (cuf, step) DO UPDATE SET payload = excluded.payload, status = excluded.status,
+                    attempts = 0, next_attempt_at = excluded.next_attempt_at, last_error = NULL,
+                    updated_at = excluded.updated_at
+            """, [(cuf, step, payload, JOB_PENDING, now, now) for step in steps])
+
+    def claim(self, step, limit):
+        """
+        Leases up to `limit` due jobs of `step` and returns them as
+        [(job_id, cuf, payload_dict, attempts)].
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            rows = self._conn.execute("""
+                SELECT id, cuf, payload, attempts FROM jobs
+                WHERE step = ? AND status IN (?, ?) AND next_attempt_at <= ?
+                ORDER BY next_attempt_at LIMIT ?
+            """, (step, JOB_PENDING, JOB_RUNNING, now, limit)).fetchall()
+            self._conn.executemany("UPDATE jobs SET status = ?, next_attempt_at = ?, updated_at = ? WHERE id = ?",
+                                   [(JOB_RUNNING, now + self.lease, now, row[0]) for row in rows])
+        return [(job_id, cuf, json.loads(payload), attempts) for job_id, cuf, payload, attempts in rows]
+
+    def complete(self, job_ids):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany("UPDATE jobs SET status = ?, last_error = NULL, updated_at = ? WHERE id = ?",
+                                   [(JOB_DONE, now, job_id) for job_id in job_ids])
+        metrics.incr("outbox_done", len(job_ids))
+
+    def fail(self, job_id, error, retryable=True):
+        """Schedules the job for another attempt with backoff, or dead-letters it."""
+        now = time.time()
+        with self._lock, self._conn:
+            attempts = self._conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()[0] + 1
+            if not retryable or attempts >= self.max_attempts:
+                status, next_attempt_at = JOB_DEAD, now
+            else:
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+                status, next_attempt_at = JOB_PENDING, now + delay + random.uniform(0, delay / 2)
+            self._conn.execute("""
+                UPDATE jobs SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ?
+                WHERE id = ?
+            """, (status, attempts, next_attempt_at, str(error), now, job_id))
+        metrics.incr("outbox_dead" if status == JOB_DEAD else "outbox_retried")
+
+    def retry_dead(self, step=None):
+        """Moves the dead letters (of one step, or all) back to pending. Returns how many."""
+        now = time.time()
+        query = "UPDATE jobs SET status = ?, attempts = 0, next_attempt_at = ?, updated_at = ? WHERE status = ?"
+        params = [JOB_PENDING, now, now, JOB_DEAD]
+        if step:
+            query += " AND step = ?"
+            params.append(step)
+        with self._lock, self._conn:
+            return self._conn.execute(query, params).rowcount
+
+    def stats(self):
+        """Returns {step: {status: count}}."""
+        with self._lock:
+            rows = self._conn.execute("SELECT step, status, COUNT(*) FROM jobs GROUP BY step, status").fetchall()
+        result = {}
+        for step, status, count in rows:
+            result.setdefault(step, {})[status] = count
+        return result
+
+    def dead_letters(self, limit=100):
+        """Returns [(cuf, step, attempts, last_error)] of the dead-lettered jobs."""
+        with self._lock:
+            return self._conn.execute("""
+                SELECT cuf, step, attempts, last_error FROM jobs WHERE status = ? ORDER BY updated_at LIMIT ?
+            """, (JOB_DEAD, limit)).fetchall()
+
+    def next_due(self):
+        """Seconds until the next pending or leased job is due, or None if there is nothing left to do."""
+        with self._lock:
+            row = self._conn.execute("SELECT MIN(next_attempt_at) FROM jobs WHERE status IN (?, ?)",
+                                     (JOB_PENDING, JOB_RUNNING)).fetchone()
+        return None if row[0] is None else max(0.0, row[0] - time.time())
+
+    def close(self):
+        self._conn.close()
+
+def _run_db_jobs(outbox, db_config, batch_size, mode):
+    """Claims and runs up to batch_size insert jobs. Returns the number of jobs claimed."""
+    import mysql.connector
+
+    jobs = outbox.claim(STEP_DB, batch_size)
+    if not jobs:
+        return 0
+    rows = []
+    for job_id, cuf, payload, _ in jobs:
+        try:
+            factura = extract_factura_from_file(payload["xml_path"])
+            rows.append((job_id, factura.to_row(payload["factura_id"], payload["pedido"])))
+        except FileNotFoundError as e:
+            outbox.fail(job_id, e)
+        except Exception as e:
+            # A malformed XML will not fix itself by retrying
+            outbox.fail(job_id, e, retryable=False)
+    if not rows:
+        return len(jobs)
+    try:
+        cnx = get_db_pool(db_config).get_connection()
+    except mysql.connector.Error as err:
+        logger.error("Sin conexión a la base de datos, %s inserciones se reintentarán: %s", len(rows), err)
+        for job_id, _ in rows:
+            outbox.fail(job_id, err)
+        return len(jobs)
+    try:
+        try:
+            insert_rows(cnx, [row for _, row in rows], batch_size, mode=mode)
+            outbox.complete([job_id for job_id, _ in rows])
+        except mysql.connector.Error as err:
+            logger.error("Error insertando un grupo de %s filas, reintentando fila por fila: %s", len(rows), err)
+            for job_id, row in rows:
+                try:
+                    insert_rows(cnx, [row], mode=mode)
+                    outbox.complete([job_id])
+                except mysql.connector.Error as row_err:
+                    outbox.fail(job_id, row_err)
+    finally:
+        cnx.close()
+    return len(jobs)
+
+def _run_upload_jobs(outbox, uploader, limit):
+    """Claims and runs up to `limit` upload jobs concurrently. Returns the number of jobs claimed."""
+    jobs = outbox.claim(STEP_UPLOAD, limit)
+    if not jobs:
+        return 0
+    uploads = uploader.upload_many([payload["xml_path"] for _, _, payload, _ in jobs])
+    done = []
+    for (job_id, _, _, _), (path, upload_status, _) in zip(jobs, uploads):
+        if upload_status == UPLOAD_FAILED:
+            outbox.fail(job_id, f"No se pudo subir '{path}' a Spaces")
+        else:
+            done.append(job_id)
+    outbox.complete(done)
+    return len(jobs)
+
+def _has_work(stats, step):
+    step_stats = stats.get(step, {})
+    return bool(step_stats.get(JOB_PENDING) or step_stats.get(JOB_RUNNING))
+
+def drenar_outbox(outbox_path, config_file, esperar=True, batch_size=500, upload_workers=8,
+                  mode=LOAD_MODE_SKIP, max_attempts=8, backoff_base=5.0, backoff_max=600.0,
+                  upload_manifest_path=None):
+    """
+    Ejecuta los trabajos pendientes del outbox: inserciones en factura_siat en grupos de
+    batch_size y subidas a Spaces con upload_workers hilos. Cada paso se reintenta por separado
+    con backoff exponencial; tras max_attempts intentos pasa a la cola de muertos (ver
+    `main.py outbox estado`). Si MySQL o Spaces no están disponibles, solo se demora ese paso.
+
+    Con esperar=True no termina hasta que no queden trabajos pendientes (durmiendo hasta el
+    próximo reintento); si no, termina en cuanto no queden trabajos vencidos.
+    mode es skip por defecto para que reintentar una inserción que sí se confirmó no duplique el CUF.
+    Devuelve Outbox.stats() al terminar.
+    """
+    outbox = Outbox(outbox_path, max_attempts, backoff_base, backoff_max)
+    db_config = None
+    uploader = None
+    try:
+        while True:
+            claimed = 0
+            stats = outbox.stats()
+            # Configuration and clients are only loaded for the steps that have work
+            if _has_work(stats, STEP_DB):
+                db_config = db_config or dict(get_db_config(config_file))
+                claimed += _run_db_jobs(outbox, db_config, batch_size, mode)
+            if _has_work(stats, STEP_UPLOAD):
+                uploader = uploader or SpacesUploader(get_spaces_config(config_file), max_workers=upload_workers,
+                                                      skip_unchanged=True, manifest_path=upload_manifest_path)
+                claimed += _run_upload_jobs(outbox, uploader, upload_workers * 4)
+            if claimed:
+                continue
+            wait = outbox.next_due()
+            if wait is None or not esperar:
+                break
+            logger.info("Sin trabajos vencidos; próximo reintento en %.1f s.", wait)
+            time.sleep(wait)
+        return outbox.stats()
+    finally:
+        outbox.close()
+
+def encolar_manifiesto(outbox_path, manifest_path, base_path, index_path=None, subir=True):
+    """
+    Busca y valida las facturas de un manifiesto (mismo formato que procesar_lote) y encola sus
+    pasos (inserción y, si subir es True, subida) para drenar_outbox.
+    Devuelve un dict {estado: cantidad} con enqueued, not_found, parse_error y validation_mismatch.
+    """
+    steps = STEPS if subir else (STEP_DB,)
+    summary = {}
+    outbox = Outbox(outbox_path)
+    try:
+        for row in read_manifest(manifest_path):
+            xml_path = find_xml_by_cuf(row["cuf"], base_path, index_path)
+            if not xml_path:
+                status = "not_found"
+            else:
+                try:
+                    factura = extract_factura_from_file(xml_path)
+                    error_validacion = validate_factura(factura, row["numero_factura"], row["total_factura"])
+                    status = "validation_mismatch" if error_validacion else "enqueued"
+                except Exception as e:
+                    logger.error("Error procesando el archivo XML '%s': %s", xml_path, e)
+                    status = "parse_error"
+            if status == "enqueued":
+                outbox.enqueue(row["cuf"], xml_path, row["factura_id"], row["pedido"], steps)
+            summary[status] = summary.get(status, 0) + 1
+    finally:
+        outbox.close()
+    return summary
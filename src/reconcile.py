@@ -0,0 +1,236 @@
+import heapq
+import json
+import logging
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from decimal import Decimal
+from itertools import groupby
+from operator import itemgetter
+
+from .cuf_index import DEFAULT_INDEX_FILE, iter_indexed_cufs, update_cuf_index
+from .metrics import metrics
+from .spaces import get_spaces_client
+from .xml_to_sql import extract_factura_from_file, get_db_config, get_spaces_config
+
+logger = logging.getLogger(__name__)
+
+# Diferencias reportadas por la reconciliación
+RECON_MISSING_IN_DB = "missing_in_db"          # XML en disco sin fila en factura_siat
+RECON_MISSING_ON_DISK = "missing_on_disk"      # fila en factura_siat sin XML en disco
+RECON_MISSING_IN_SPACES = "missing_in_spaces"  # fila en factura_siat sin objeto en upload_folder
+RECON_EXTRA_IN_SPACES = "extra_in_spaces"      # objeto en upload_folder sin fila en factura_siat
+RECON_MONTO_MISMATCH = "monto_mismatch"        # montoTotal del XML distinto del de factura_siat
+RECON_PARSE_ERROR = "parse_error"              # no se pudo leer el montoTotal del XML
+
+# Sources of merge_cuf_streams, in this order
+SOURCE_DISK = 0
+SOURCE_DB = 1
+SOURCE_SPACES = 2
+
+# Marks a CUF absent from a source in merge_cuf_streams
+MISSING = object()
+
+# Largest difference between the montoTotal of the XML and of factura_siat that is not reported
+MONTO_TOLERANCE = Decimal("0.01")
+
+def _prefetch(pages, max_pages=4):
+    """
+    Iterates over the items of an iterable of pages that is consumed in a background thread, up
+    to max_pages ahead, so slow sources (MySQL, Spaces) are fetched at the same time as the
+    others are merged. Exceptions of the producer are re-raised in the consumer.
+    """
+    buffer = queue.Queue(max_pages)
+    done = object()
+
+    def produce():
+        try:
+            for page in pages:
+                buffer.put(page)
+            buffer.put(done)
+        except BaseException as e:
+            buffer.put(e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        page = buffer.get()
+        if page is done:
+            return
+        if isinstance(page, BaseException):
+            raise page
+        yield from page
+
+def _cuf_is_binary(cursor):
+    """
+    True if factura_siat.cuf compares byte by byte (a _bin collation or a binary type), i.e. if
+    MySQL orders CUFs as Python does.
+    """
+    cursor.execute("SELECT COLLATION_NAME FROM information_schema.COLUMNS "
+                   "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'factura_siat' AND COLUMN_NAME = 'cuf'")
+    row = cursor.fetchone()
+    return row is not None and (row[0] is None or row[0].endswith("_bin"))
+
+def iter_db_pages(db_config, page_size=10_000):
+    """
+    Yields pages of (cuf, montoTotal) from factura_siat in ascending CUF order using keyset
+    pagination (WHERE cuf > last ORDER BY cuf LIMIT n), so each query is an index range scan
+    no matter how deep the page is.
+    The merge needs the byte order Python uses for the other sources. With a case-insensitive
+    or padding collation on cuf the queries compare BINARY cuf instead, which is correct but
+    cannot use the index, so a warning is logged.
+    """
+    import mysql.connector
+
+    cnx = mysql.connector.connect(**db_config)
+    try:
+        cursor = cnx.cursor()
+        try:
+            if _cuf_is_binary(cursor):
+                query = "SELECT cuf, montoTotal FROM factura_siat WHERE cuf > %s ORDER BY cuf LIMIT %s"
+            else:
+                logger.warning("factura_siat.cuf no tiene una collation binaria; se ordena por BINARY cuf, "
+                               "sin usar el índice.")
+                query = ("SELECT cuf, montoTotal FROM factura_siat WHERE BINARY cuf > %s "
+                         "ORDER BY BINARY cuf LIMIT %s")
+            last = ""
+            while True:
+                with metrics.timer("reconcile_db_page"):
+                    cursor.execute(query, (last, page_size))
+                    page = cursor.fetchall()
+                if not page:
+                    return
+                yield page
+                if len(page) < page_size:
+                    return
+                last = page[-1][0]
+        finally:
+            cursor.close()
+    finally:
+        cnx.close()
+
+def iter_spaces_pages(spaces_config, page_size=1000):
+    """
+    Yields pages of (cuf, key) for the <CUF>.xml objects directly inside upload_folder, in
+    ascending key (and therefore CUF) order as returned by list_objects_v2.
+    """
+    upload_folder = spaces_config.get('upload_folder', 'obs/xmls/')
+    if upload_folder and not upload_folder.endswith('/'):
+        upload_folder += '/'
+    paginator = get_spaces_client(spaces_config).get_paginator('list_objects_v2')
+    for response in paginator.paginate(Bucket=spaces_config['bucket_name'], Prefix=upload_folder,
+                                       PaginationConfig={"PageSize": page_size}):
+        page = []
+        for obj in response.get("Contents", []):
+            name = obj["Key"][len(upload_folder):]
+            if name.endswith(".xml") and "/" not in name:
+                page.append((name[:-4], obj["Key"]))
+        yield page
+
+def _ordered(stream, source):
+    """Checks that a (cuf, value) stream is sorted, dropping repeated CUFs (the first one is kept)."""
+    previous = None
+    for cuf, value in stream:
+        if previous is not None and cuf <= previous:
+            if cuf == previous:
+                continue
+            raise ValueError(f"Los CUF de {source} no están ordenados ('{previous}' antes de '{cuf}').")
+        previous = cuf
+        yield cuf, value
+
+def _tagged(stream, index):
+    for cuf, value in stream:
+        yield cuf, index, value
+
+def merge_cuf_streams(*streams):
+    """
+    Sorted-merge join of (cuf, value) streams sorted by CUF. Yields (cuf, values) for every CUF
+    in any stream, with values[i] the value from streams[i] or MISSING. Only one item per stream
+    is held in memory.
+    """
+    merged = heapq.merge(*(_tagged(stream, index) for index, stream in enumerate(streams)), key=itemgetter(0))
+    for cuf, group in groupby(merged, key=itemgetter(0)):
+        values = [MISSING] * len(streams)
+        for _, index, value in group:
+            values[index] = value
+        yield cuf, values
+
+def _monto_total(xml_path):
+    """montoTotal of one XML; runs in the worker processes."""
+    try:
+        return extract_factura_from_file(xml_path).montoTotal, None
+    except Exception as e:
+        return None, str(e)
+
+def reconciliar(config_file, base_path=".", index_path=DEFAULT_INDEX_FILE, output_path="reconciliacion.jsonl",
+                spaces=True, montos=False, actualizar_indice=True, page_size=10_000, workers=None,
+                monto_batch_size=5000):
+    """
+    Compara los CUF del árbol de XML, de factura_siat y de upload_folder en Spaces y escribe en
+    output_path (JSONL) una línea por diferencia: missing_in_db, missing_on_disk,
+    missing_in_spaces, extra_in_spaces y, con montos=True, monto_mismatch (montoTotal del XML
+    y de la base difieren en más de MONTO_TOLERANCE) o parse_error.
+
+    Cada fuente se lee ordenada por CUF y en streaming: el disco desde el índice de CUFs
+    (actualizado antes, salvo actualizar_indice=False), la base con una única pasada paginada por
+    clave y Spaces con la paginación de list_objects_v2. Las tres se combinan con un merge
+    ordenado, así que la memoria no depende de la cantidad de facturas; la base y Spaces se
+    descargan en segundo plano mientras se combinan. Los montos se leen de los XML en workers
+    procesos, en grupos de monto_batch_size facturas.
+    Devuelve un dict con la cantidad de CUF por fuente (disk, db, spaces) y de cada diferencia.
+    """
+    if actualizar_indice:
+        update_cuf_index(index_path, base_path)
+    streams = [_ordered(iter_indexed_cufs(index_path, base_path), "el índice de CUFs"),
+               _ordered(_prefetch(iter_db_pages(get_db_config(config_file), page_size)), "factura_siat")]
+    if spaces:
+        streams.append(_ordered(_prefetch(iter_spaces_pages(get_spaces_config(config_file))), "Spaces"))
+    summary = {"disk": 0, "db": 0}
+    if spaces:
+        summary["spaces"] = 0
+    pending = []
+
+    executor_context = ProcessPoolExecutor(max_workers=workers) if montos else nullcontext()
+    with open(output_path, 'w', encoding='utf-8') as output, executor_context as executor:
+
+        def write(cuf, issue, **fields):
+            summary[issue] = summary.get(issue, 0) + 1
+            output.write(json.dumps(dict(cuf=cuf, issue=issue, **fields), ensure_ascii=False, default=str) + "\n")
+
+        def compare_montos():
+            paths = [xml_path for _, xml_path, _ in pending]
+            with metrics.timer("reconcile_montos"):
+                results = list(executor.map(_monto_total, paths, chunksize=64))
+            for (cuf, xml_path, db_monto), (xml_monto, error) in zip(pending, results):
+                if error is not None:
+                    write(cuf, RECON_PARSE_ERROR, xml_path=xml_path, error=error)
+                elif (db_monto is None or xml_monto is None
+                      or abs(Decimal(str(db_monto)) - Decimal(str(xml_monto))) > MONTO_TOLERANCE):
+                    write(cuf, RECON_MONTO_MISMATCH, xml_path=xml_path, montoTotal_xml=xml_monto,
+                          montoTotal_db=db_monto)
+            pending.clear()
+
+        for cuf, values in merge_cuf_streams(*streams):
+            xml_path, db_monto = values[SOURCE_DISK], values[SOURCE_DB]
+            on_disk, in_db = xml_path is not MISSING, db_monto is not MISSING
+            summary["disk"] += on_disk
+            summary["db"] += in_db
+            if on_disk and not in_db:
+                write(cuf, RECON_MISSING_IN_DB, xml_path=xml_path)
+            elif in_db and not on_disk:
+                write(cuf, RECON_MISSING_ON_DISK)
+            elif on_disk and montos:
+                pending.append((cuf, xml_path, db_monto))
+                if len(pending) >= monto_batch_size:
+                    compare_montos()
+            if spaces:
+                in_spaces = values[SOURCE_SPACES] is not MISSING
+                summary["spaces"] += in_spaces
+                if in_db and not in_spaces:
+                    write(cuf, RECON_MISSING_IN_SPACES)
+                elif in_spaces and not in_db:
+                    write(cuf, RECON_EXTRA_IN_SPACES, key=values[SOURCE_SPACES])
+        if pending:
+            compare_montos()
+    logger.info("Reconciliación terminada: %s", summary)
+    return summary
@@ -0,0 +1,307 @@
+import hashlib
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# boto3/botocore are imported inside the functions below, the first time an upload needs them
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Error codes returned by S3/Spaces when requests are being rate limited
+THROTTLING_ERROR_CODES = {"SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded",
+                          "TooManyRequests", "ServiceUnavailable", "503"}
+
+# Resultado de cada subida
+UPLOAD_UPLOADED = "uploaded"
+UPLOAD_SKIPPED = "skipped"
+UPLOAD_FAILED = "failed"
+
+# Contador de métricas de cada resultado de subida
+UPLOAD_COUNTERS = {UPLOAD_UPLOADED: "files_uploaded", UPLOAD_SKIPPED: "uploads_skipped", UPLOAD_FAILED: "uploads_failed"}
+
+def get_spaces_key(spaces_config, local_file_path):
+    """Builds the Spaces object key for a local file inside the configured upload_folder."""
+    # Ensure upload_folder ends with a slash if it's not empty
+    upload_folder = spaces_config.get('upload_folder', 'obs/xmls/')
+    if upload_folder and not upload_folder.endswith('/'):
+        upload_folder += '/'
+    return f"{upload_folder}{os.path.basename(local_file_path)}"
+
+def create_spaces_client(spaces_config, max_pool_connections=10, max_attempts=5, connect_timeout=60,
+                         read_timeout=60):
+    """
+    Creates an S3 client for DigitalOcean Spaces with a connection pool sized for
+    max_pool_connections concurrent requests and botocore's standard retry mode.
+    Works against any S3-compatible endpoint (e.g. a local moto server) set in endpoint_url.
+    The timeouts (seconds) default to botocore's.
+    """
+    import boto3
+    from botocore.config import Config
+
+    session = boto3.session.Session()
+    return session.client('s3',
+                          region_name=spaces_config['region_name'],
+                          endpoint_url=spaces_config['endpoint_url'],
+                          aws_access_key_id=spaces_config['aws_access_key_id'],
+                          aws_secret_access_key=spaces_config['aws_secret_access_key'],
+                          config=Config(max_pool_connections=max_pool_connections,
+                                        connect_timeout=connect_timeout, read_timeout=read_timeout,
+                                        retries={"max_attempts": max_attempts, "mode": "standard"}))
+
+def hash_file(local_file_path, chunk_size=1024 * 1024):
+    """Returns (md5_hex, sha256_hex) of a file, reading it once."""
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(local_file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            md5.update(chunk)
+            sha256.update(chunk)
+    return md5.hexdigest(), sha256.hexdigest()
+
+class UploadManifest:
+    """
+    Local SQLite cache of the objects already uploaded: key -> sha256 plus the size and mtime
+    of the local file at upload time. Lets unchanged files be skipped without hashing them or
+    asking Spaces.
+    """
+
+    def __init__(self, manifest_path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(manifest_path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS uploads (
+                key TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL
+            )
+        """)
+
+    def get(self, key):
+        """Returns (sha256, size, mtime_ns) for key, or None."""
+        with self._lock:
+            return self._conn.execute("SELECT sha256, size, mtime_ns FROM uploads WHERE key = ?", (key,)).fetchone()
+
+    def put(self, key, sha256, size, mtime_ns):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO uploads (key, sha256, size, mtime_ns) VALUES (?, ?, ?, ?)",
+                               (key, sha256, size, mtime_ns))
+
+    def close(self):
+        self._conn.close()
+
+def _is_throttling(error):
+    from boto3.exceptions import S3UploadFailedError
+    from botocore.exceptions import ClientError
+
+    if isinstance(error, ClientError):
+        error = error.response.get("Error", {})
+        return error.get("Code") in THROTTLING_ERROR_CODES
+    # upload_file wraps the final ClientError message in S3UploadFailedError
+    return isinstance(error, S3UploadFailedError) and any(code in str(error) for code in THROTTLING_ERROR_CODES)
+
+class SpacesUploader:
+    """
+    Uploads files to DigitalOcean Spaces reusing a single S3 client (and its connection pool).
+
+    Files smaller than multipart_threshold are sent with a single PutObject; larger ones go
+    through the multipart transfer manager. Throttling errors that survive botocore's own
+    retries are retried up to max_attempts times with exponential backoff and jitter.
+    A client can be injected (e.g. one created inside moto's mock_aws) for testing.
+
+    With skip_unchanged=True every object is uploaded with its SHA-256 in the x-amz-meta-sha256
+    metadata, and files whose content is already in Spaces are skipped. The check first uses the
+    optional local manifest (manifest_path) and otherwise a HEAD request, comparing the remote
+    sha256 metadata or, for single-part uploads, the ETag against the local MD5.
+    """
+
+    def __init__(self, spaces_config, max_workers=8, max_attempts=5, backoff_base=0.5,
+                 multipart_threshold=16 * 1024 * 1024, client=None, skip_unchanged=False, manifest_path=None):
+        self.spaces_config = spaces_config
+        self.skip_unchanged = skip_unchanged
+        self.manifest = UploadManifest(manifest_path) if manifest_path else None
+        self.bucket_name = spaces_config['bucket_name']
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.multipart_threshold = multipart_threshold
+        self._client = client
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        """The S3 client, created on first use so an uploader that skips everything never imports boto3."""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = create_spaces_client(self.spaces_config, max_pool_connections=self.max_workers,
+                                                        max_attempts=self.max_attempts)
+        return self._client
+
+    def public_url(self, spaces_file_key):
+        return f"{self.spaces_config['endpoint_url']}/{self.bucket_name}/{spaces_file_key}"
+
+    def _remote_matches(self, spaces_file_key, md5_hex, sha256_hex):
+        """HEADs the object and tells whether its content matches the local hashes."""
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.client.head_object(Bucket=self.bucket_name, Key=spaces_file_key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        if response.get("Metadata", {}).get("sha256") == sha256_hex:
+            return True
+        return response.get("ETag", "").strip('"') == md5_hex
+
+    def _is_unchanged(self, local_file_path, spaces_file_key):
+        """
+        Returns (unchanged, sha256_hex, stat). The local manifest answers without hashing when the
+        file's size and mtime are the ones recorded at upload time.
+        """
+        st = os.stat(local_file_path)
+        cached = self.manifest.get(spaces_file_key) if self.manifest else None
+        if cached and cached[1] == st.st_size and cached[2] == st.st_mtime_ns:
+            return True, cached[0], st
+        md5_hex, sha256_hex = hash_file(local_file_path)
+        if cached and cached[0] == sha256_hex:
+            return True, sha256_hex, st
+        return self._remote_matches(spaces_file_key, md5_hex, sha256_hex), sha256_hex, st
+
+    def _send(self, local_file_path, spaces_file_key, sha256_hex=None):
+        extra_args = {
+            'ACL': 'public-read',
+            'ContentType': 'application/xml'  # Explicitly set ContentType
+        }
+        if sha256_hex:
+            extra_args['Metadata'] = {'sha256': sha256_hex}
+        if os.path.getsize(local_file_path) < self.multipart_threshold:
+            with open(local_file_path, 'rb') as file:
+                self.client.put_object(Bucket=self.bucket_name, Key=spaces_file_key, Body=file, **extra_args)
+        else:
+            from boto3.s3.transfer import TransferConfig
+
+            self.client.upload_file(Filename=local_file_path, Bucket=self.bucket_name, Key=spaces_file_key,
+                                    ExtraArgs=extra_args, Config=TransferConfig(multipart_threshold=self.multipart_threshold))
+
+    def upload(self, local_file_path, spaces_file_key=None):
+        """
+        Uploads one file. spaces_file_key defaults to the file name inside upload_folder.
+        Returns (True, public_url) on success (or when skipped as unchanged), (False, None) otherwise.
+        """
+        status, public_url = self.upload_with_status(local_file_path, spaces_file_key)
+        return status != UPLOAD_FAILED, public_url
+
+    def upload_with_status(self, local_file_path, spaces_file_key=None):
+        """
+        Like upload, but returns (status, public_url) with status one of
+        UPLOAD_UPLOADED, UPLOAD_SKIPPED or UPLOAD_FAILED.
+        """
+        with metrics.timer("upload"):
+            status, public_url = self._upload_with_status(local_file_path, spaces_file_key)
+        metrics.incr(UPLOAD_COUNTERS[status])
+        return status, public_url
+
+    def _upload_with_status(self, local_file_path, spaces_file_key):
+        from boto3.exceptions import S3UploadFailedError
+        from botocore.exceptions import ClientError, NoCredentialsError, PartialCredentialsError
+
+        spaces_file_key = spaces_file_key or get_spaces_key(self.spaces_config, local_file_path)
+        try:
+            sha256_hex = None
+            if self.skip_unchanged:
+                unchanged, sha256_hex, st = self._is_unchanged(local_file_path, spaces_file_key)
+                if unchanged:
+                    if self.manifest:
+                        self.manifest.put(spaces_file_key, sha256_hex, st.st_size, st.st_mtime_ns)
+                    logger.info("Archivo '%s' sin cambios en Spaces, se omite la subida.", os.path.basename(local_file_path))
+                    return UPLOAD_SKIPPED, self.public_url(spaces_file_key)
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    self._send(local_file_path, spaces_file_key, sha256_hex)
+                    break
+                except (ClientError, S3UploadFailedError) as e:
+                    if attempt == self.max_attempts or not _is_throttling(e):
+                        raise
+                    delay = self.backoff_base * 2 ** (attempt - 1)
+                    time.sleep(delay + random.uniform(0, delay))
+            if self.skip_unchanged and self.manifest:
+                self.manifest.put(spaces_file_key, sha256_hex, st.st_size, st.st_mtime_ns)
+            logger.info("Archivo '%s' subido exitosamente a Spaces como '%s'.", os.path.basename(local_file_path), spaces_file_key)
+            # Construct and print the public URL
+            public_url = self.public_url(spaces_file_key)
+            logger.info("URL pública: %s", public_url)
+            return UPLOAD_UPLOADED, public_url
+        except FileNotFoundError:
+            logger.error("Error: El archivo local '%s' no fue encontrado.", local_file_path)
+            return UPLOAD_FAILED, None
+        except (NoCredentialsError, PartialCredentialsError):
+            logger.error("Error: Credenciales de AWS/Spaces no encontradas o incompletas. Asegúrese de que estén configuradas en db_config.ini.")
+            return UPLOAD_FAILED, None
+        except ClientError as e:
+            # More specific error handling for S3-related errors
+            error_code = e.response.get("Error", {}).get("Code")
+            if error_code == "InvalidAccessKeyId":
+                logger.error("Error: AWS Access Key ID inválido.")
+            elif error_code == "SignatureDoesNotMatch":
+                logger.error("Error: AWS Secret Access Key inválido.")
+            elif error_code == "NoSuchBucket":
+                logger.error("Error: El bucket '%s' no existe.", self.bucket_name)
+            else:
+                logger.error("Error de Cliente al subir a Spaces: %s (Código: %s)", e, error_code)
+            return UPLOAD_FAILED, None
+        except Exception as e:
+            logger.error("Un error inesperado ocurrió al subir a Spaces: %s", e)
+            return UPLOAD_FAILED, None
+
+    def upload_many(self, local_file_paths, spaces_file_keys=None):
+        """
+        Uploads many files concurrently with up to max_workers threads sharing the client.
+        Returns a list of (local_file_path, status, public_url) in the input order, with status
+        one of UPLOAD_UPLOADED, UPLOAD_SKIPPED or UPLOAD_FAILED.
+        """
+        local_file_paths = list(local_file_paths)
+        spaces_file_keys = list(spaces_file_keys) if spaces_file_keys is not None else [None] * len(local_file_paths)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = executor.map(self.upload_with_status, local_file_paths, spaces_file_keys)
+            return [(path, status, public_url) for path, (status, public_url) in zip(local_file_paths, results)]
+
+_uploaders = {}
+_uploaders_lock = threading.Lock()
+
+def get_spaces_uploader(spaces_config, **kwargs):
+    """
+    Returns a SpacesUploader for spaces_config, reusing the one already created for the same
+    [SPACES] section (endpoint, region, credentials, bucket, upload_folder) and options so
+    repeated uploads share the client.
+    """
+    cache_key = (tuple(sorted(spaces_config.items())), tuple(sorted(kwargs.items())))
+    with _uploaders_lock:
+        uploader = _uploaders.get(cache_key)
+        if uploader is None:
+            uploader = SpacesUploader(spaces_config, **kwargs)
+            _uploaders[cache_key] = uploader
+        return uploader
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_spaces_client(spaces_config, **kwargs):
+    """
+    Returns an S3 client for spaces_config, created on first use and reused afterwards by the
+    calls with the same endpoint, region, credentials and create_spaces_client options.
+    """
+    cache_key = (spaces_config['endpoint_url'], spaces_config['region_name'], spaces_config['aws_access_key_id'],
+                 spaces_config['aws_secret_access_key'], tuple(sorted(kwargs.items())))
+    with _clients_lock:
+        client = _clients.get(cache_key)
+        if client is None:
+            client = create_spaces_client(spaces_config, **kwargs)
+            _clients[cache_key] = client
+        return client
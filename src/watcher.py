@@ -0,0 +1,309 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from .batch import read_manifest
+from .ingest import iter_xml_files
+from .metrics import metrics
+from .spaces import UPLOAD_FAILED, SpacesUploader
+from .xml_to_sql import (
+    LOAD_MODE_SKIP,
+    extract_factura_from_file,
+    get_db_config,
+    get_db_pool,
+    get_spaces_config,
+    insert_rows,
+    validate_factura,
+)
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+    from watchdog.observers.polling import PollingObserver
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = PollingObserver = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHECKPOINT_FILE = "watch_checkpoint.sqlite"
+
+# Estados guardados en el checkpoint
+WATCH_DONE = "done"
+WATCH_PARSE_ERROR = "parse_error"
+WATCH_VALIDATION_MISMATCH = "validation_mismatch"
+WATCH_NOT_IN_MANIFEST = "not_in_manifest"
+
+class WatchCheckpoint:
+    """
+    SQLite record of the files already handled: path -> size and mtime at the time they were
+    processed, plus the outcome. A file is handled again only when its size or mtime change.
+    """
+
+    def __init__(self, checkpoint_path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(checkpoint_path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                processed_at REAL NOT NULL
+            )
+        """)
+
+    def is_seen(self, path, st):
+        with self._lock:
+            row = self._conn.execute("SELECT size, mtime_ns FROM files WHERE path = ?", (path,)).fetchone()
+        return row == (st.st_size, st.st_mtime_ns)
+
+    def put_many(self, entries):
+        """entries: iterable of (path, stat_result, status)."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, status, processed_at) VALUES (?, ?, ?, ?, ?)",
+                [(path, st.st_size, st.st_mtime_ns, status, now) for path, st, status in entries])
+
+    def close(self):
+        self._conn.close()
+
+class _XmlEventHandler(FileSystemEventHandler):
+    """Forwards created, modified and moved-in .xml files to the watcher."""
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.watcher.notify(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.watcher.notify(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.watcher.notify(event.dest_path)
+
+class FolderWatcher:
+    """
+    Watches base_path for new or modified <CUF>.xml files and runs them through
+    parse -> insert -> upload.
+
+    Events come from watchdog (inotify and equivalents, or its PollingObserver with
+    polling=True, e.g. for network shares). Without watchdog the tree is rescanned every
+    poll_interval seconds. A file is processed once it has not changed for `debounce` seconds,
+    so partially written files are not parsed. Ready files are inserted together in one
+    transaction with insert_rows and recorded in the checkpoint; on start, files whose size
+    and mtime are already in the checkpoint are not processed again. Rows that fail to insert
+    and uploads that fail are retried after retry_delay seconds without being checkpointed; a
+    failed upload is retried without inserting the row again while the watcher keeps running
+    (after a restart the row goes through the load mode again, skip by default).
+
+    manifest ({cuf: row} as produced by read_manifest) supplies factura_id and pedido and the
+    values to validate; without it both are NULL. mode defaults to skip so a file that is
+    modified after being ingested does not duplicate its CUF (use upsert to update it instead).
+    """
+
+    def __init__(self, base_path, db_config, checkpoint_path=DEFAULT_CHECKPOINT_FILE, uploader=None,
+                 manifest=None, mode=LOAD_MODE_SKIP, debounce=2.0, poll_interval=5.0, polling=False,
+                 retry_delay=30.0, batch_size=500):
+        self.base_path = base_path
+        self.db_config = db_config
+        self.checkpoint = WatchCheckpoint(checkpoint_path)
+        self.uploader = uploader
+        self.manifest = manifest
+        self.mode = mode
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.polling = polling
+        self.retry_delay = retry_delay
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        # path -> (time of the last event, (size, mtime_ns) seen then or None)
+        self._pending = {}
+        # path -> (size, mtime_ns) of the inserted files whose upload failed
+        self._upload_retries = {}
+        self._stop = threading.Event()
+
+    def notify(self, path):
+        """Marks path as changed; safe to call from any thread."""
+        if not path.endswith(".xml"):
+            return
+        metrics.incr("files_detected")
+        with self._lock:
+            self._pending[path] = (time.monotonic(), None)
+
+    def stop(self):
+        self._stop.set()
+
+    def _scan(self):
+        """Queues every XML under base_path that is not in the checkpoint with its current size and mtime."""
+        for path in iter_xml_files(self.base_path):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if not self.checkpoint.is_seen(path, st):
+                with self._lock:
+                    self._pending.setdefault(path, (time.monotonic(), None))
+
+    def _take_ready(self):
+        """Returns [(path, stat)] of the pending files that stayed unchanged for the debounce period."""
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            for path, (last_event, last_stat) in list(self._pending.items()):
+                if now - last_event < self.debounce:
+                    continue
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    del self._pending[path]
+                    continue
+                current = (st.st_size, st.st_mtime_ns)
+                if current != last_stat:
+                    # Still being written (or first check): wait another debounce period
+                    self._pending[path] = (now, current)
+                    continue
+                del self._pending[path]
+                ready.append((path, st))
+        return ready
+
+    def _requeue(self, paths, delay):
+        retry_at = time.monotonic() + delay - self.debounce
+        with self._lock:
+            for path in paths:
+                self._pending.setdefault(path, (retry_at, None))
+
+    def process(self, ready):
+        """Parses, inserts and uploads the ready files and records them in the checkpoint."""
+        import mysql.connector
+
+        entries = []
+        parsed = []
+        upload_only = []
+        for path, st in ready:
+            if self._upload_retries.pop(path, None) == (st.st_size, st.st_mtime_ns):
+                upload_only.append((path, st, None))
+                continue
+            cuf = os.path.basename(path)[:-4]
+            manifest_row = None
+            if self.manifest is not None:
+                manifest_row = self.manifest.get(cuf)
+                if manifest_row is None:
+                    entries.append((path, st, WATCH_NOT_IN_MANIFEST))
+                    continue
+            try:
+                factura = extract_factura_from_file(path)
+                if manifest_row is None:
+                    row = factura.to_row(None)
+                else:
+                    error_validacion = validate_factura(factura, manifest_row["numero_factura"],
+                                                        manifest_row["total_factura"])
+                    if error_validacion:
+                        logger.error("Error de validación en '%s': %s", path, error_validacion)
+                        entries.append((path, st, WATCH_VALIDATION_MISMATCH))
+                        continue
+                    row = factura.to_row(manifest_row["factura_id"], manifest_row["pedido"])
+            except Exception as e:
+                logger.error("Error procesando el archivo XML '%s': %s", path, e)
+                entries.append((path, st, WATCH_PARSE_ERROR))
+                continue
+            parsed.append((path, st, row))
+
+        if parsed:
+            try:
+                cnx = get_db_pool(self.db_config).get_connection()
+                try:
+                    insert_rows(cnx, [row for _, _, row in parsed], self.batch_size, mode=self.mode)
+                finally:
+                    cnx.close()
+            except mysql.connector.Error as err:
+                logger.error("Error insertando %s facturas, se reintentarán en %s s: %s",
+                             len(parsed), self.retry_delay, err)
+                self._requeue([path for path, _, _ in parsed], self.retry_delay)
+                parsed = []
+        to_upload = parsed + upload_only
+        if to_upload and self.uploader is not None:
+            uploads = self.uploader.upload_many([path for path, _, _ in to_upload])
+            failed = []
+            for (path, st, _), (_, upload_status, _) in zip(to_upload, uploads):
+                if upload_status == UPLOAD_FAILED:
+                    self._upload_retries[path] = (st.st_size, st.st_mtime_ns)
+                    failed.append(path)
+                else:
+                    entries.append((path, st, WATCH_DONE))
+            if failed:
+                logger.error("Error subiendo %s archivos, se reintentarán en %s s.", len(failed), self.retry_delay)
+                self._requeue(failed, self.retry_delay)
+        else:
+            entries.extend((path, st, WATCH_DONE) for path, st, _ in to_upload)
+        if entries:
+            self.checkpoint.put_many(entries)
+            logger.info("%s archivos procesados (%s insertados).", len(entries), len(parsed))
+
+    def _make_observer(self):
+        if Observer is None:
+            return None
+        observer = PollingObserver(timeout=self.poll_interval) if self.polling else Observer()
+        observer.schedule(_XmlEventHandler(self), self.base_path, recursive=True)
+        return observer
+
+    def run(self, tick=0.5):
+        """Runs until stop() is called (or KeyboardInterrupt), processing files as they become ready."""
+        observer = self._make_observer()
+        if observer is not None:
+            observer.start()
+        else:
+            logger.warning("watchdog no está instalado; se re-escanea '%s' cada %s s.", self.base_path, self.poll_interval)
+        try:
+            # Catch up with the files written while the watcher was not running
+            self._scan()
+            last_scan = time.monotonic()
+            while not self._stop.is_set():
+                if observer is None and time.monotonic() - last_scan >= self.poll_interval:
+                    self._scan()
+                    last_scan = time.monotonic()
+                ready = self._take_ready()
+                for start in range(0, len(ready), self.batch_size):
+                    batch = ready[start:start + self.batch_size]
+                    try:
+                        self.process(batch)
+                    except Exception:
+                        # Keep the watcher alive; the files are retried like failed inserts
+                        logger.exception("Error procesando %s archivos, se reintentarán en %s s.",
+                                         len(batch), self.retry_delay)
+                        self._requeue([path for path, _ in batch], self.retry_delay)
+                self._stop.wait(tick)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+            self.checkpoint.close()
+
+def vigilar_carpeta(base_path, config_file, checkpoint_path=DEFAULT_CHECKPOINT_FILE, subir=False,
+                    manifest_path=None, mode=LOAD_MODE_SKIP, debounce=2.0, poll_interval=5.0, polling=False,
+                    upload_workers=8, upload_manifest_path=None):
+    """
+    Vigila base_path e ingiere cada XML nuevo o modificado en pocos segundos (ver FolderWatcher).
+    Si subir es True, los XML insertados se suben a Spaces omitiendo los que no cambiaron.
+    Bloquea hasta Ctrl+C.
+    """
+    manifest = None
+    if manifest_path:
+        manifest = {row["cuf"]: row for row in read_manifest(manifest_path)}
+    uploader = None
+    if subir:
+        uploader = SpacesUploader(get_spaces_config(config_file), max_workers=upload_workers,
+                                  skip_unchanged=True, manifest_path=upload_manifest_path)
+    watcher = FolderWatcher(base_path, dict(get_db_config(config_file)), checkpoint_path, uploader, manifest,
+                            mode, debounce, poll_interval, polling)
+    logger.info("Vigilando '%s' (Ctrl+C para terminar)...", base_path)
+    watcher.run()
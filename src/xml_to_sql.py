@@ -1,231 +1,501 @@
 import xml.etree.ElementTree as ET
-from datetime import datetime
+import logging
+from dataclasses import dataclass, fields
+from decimal import Decimal
+from operator import attrgetter, itemgetter
 import os
+import re
 import configparser
-import mysql.connector
-import boto3 # Import boto3
-from botocore.exceptions import NoCredentialsError, PartialCredentialsError, ClientError # Import specific exceptions
+# mysql.connector and boto3 are imported inside the functions that talk to MySQL or Spaces, so
+# parse-only and dry-run paths do not pay for importing them.
+from .cuf_index import find_xml_in_index
+from .metrics import metrics
+from .spaces import get_spaces_key, get_spaces_uploader
 
-def get_db_config(config_file_path="db_config.ini"):
-    """Reads database configuration from an INI file."""
+try:
+    from lxml.etree import XMLPullParser as _XMLPullParser
+except ImportError:
+    _XMLPullParser = ET.XMLPullParser
+
+# Bytes fed to the pull parser at a time; the cabecera usually fits in the first chunk
+_PARSE_CHUNK_SIZE = 16 * 1024
+
+logger = logging.getLogger(__name__)
+
+_configs = {}
+
+def load_config(config_file_path="db_config.ini"):
+    """
+    Returns the parsed INI file. It is read once and cached; the cached copy is reused until the
+    file's size or mtime change, so per-invoice calls do not re-parse it.
+    """
+    try:
+        st = os.stat(config_file_path)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Configuration file {config_file_path} not found.") from None
+    cache_key = os.path.abspath(config_file_path)
+    cached = _configs.get(cache_key)
+    if cached is not None and cached[0] == (st.st_size, st.st_mtime_ns):
+        return cached[1]
     config = configparser.ConfigParser()
-    if not os.path.exists(config_file_path):
-        raise FileNotFoundError(f"Configuration file {config_file_path} not found.")
     config.read(config_file_path)
+    _configs[cache_key] = ((st.st_size, st.st_mtime_ns), config)
+    return config
+
+def get_db_config(config_file_path="db_config.ini"):
+    """Reads database configuration from an INI file (cached, see load_config)."""
+    config = load_config(config_file_path)
     if 'DATABASE' not in config:
         raise ValueError("DATABASE section not found in the configuration file.")
     return config['DATABASE']
 
-def connect_to_db(db_config):
-    """Connects to the MySQL database."""
+def connect_to_db(db_config, pooled=False):
+    """
+    Connects to the MySQL database. With pooled=True the connection comes from get_db_pool, so
+    repeated calls reuse open connections; close() returns it to the pool.
+    """
+    import mysql.connector
+
     try:
+        if pooled:
+            return get_db_pool(db_config).get_connection()
         cnx = mysql.connector.connect(**db_config)
         return cnx
     except mysql.connector.Error as err:
-        print(f"Error connecting to database: {err}")
+        logger.error("Error connecting to database: %s", err)
         return None
 
 def execute_sql(cnx, sql_query):
     """Executes an SQL query on the given database connection."""
+    import mysql.connector
+
     cursor = None
     try:
-        cursor = cnx.cursor()
-        cursor.execute(sql_query)
-        cnx.commit()
-        print("SQL query executed successfully.")
+        with metrics.timer("execute_sql"):
+            cursor = cnx.cursor()
+            cursor.execute(sql_query)
+            cnx.commit()
+        logger.info("SQL query executed successfully.")
         return True
     except mysql.connector.Error as err:
-        print(f"Error executing SQL query: {err}")
+        metrics.incr("insert_failed")
+        logger.error("Error executing SQL query: %s", err)
         cnx.rollback()
         return False
     finally:
         if cursor:
             cursor.close()
 
-def run_connectivity_checks(config_file_path="db_config.ini"):
+_db_pools = {}
+
+def get_db_pool(db_config, pool_name="siat_xml_to_sql", pool_size=5):
     """
-    Prueba la conexión a la base de datos y a DigitalOcean Spaces.
+    Returns a MySQL connection pool for db_config, creating it on first use.
+    Pools are cached by name, size and configuration, so repeated calls reuse the same
+    connections and a changed configuration (e.g. another connection_timeout) gets a new pool.
     """
-    print("--- Iniciando Pruebas de Conectividad ---")
-    db_connection_ok = False
-    spaces_connection_ok = False
+    cache_key = (pool_name, pool_size, tuple(sorted(db_config.items())))
+    pool = _db_pools.get(cache_key)
+    if pool is None:
+        import mysql.connector.pooling
+
+        pool = mysql.connector.pooling.MySQLConnectionPool(pool_name=pool_name, pool_size=pool_size, **db_config)
+        _db_pools[cache_key] = pool
+    return pool
 
-    # --- Prueba de Conexión a la Base de Datos ---
-    print("\\n--- Prueba de Conexión a la Base de Datos ---")
+# Modos de carga de insert_rows
+LOAD_MODE_INSERT = "insert"   # INSERT simple
+LOAD_MODE_UPSERT = "upsert"   # INSERT ... ON DUPLICATE KEY UPDATE (requiere un índice UNIQUE en cuf)
+LOAD_MODE_SKIP = "skip"       # omite los CUF que ya existen en factura_siat
+LOAD_MODES = (LOAD_MODE_INSERT, LOAD_MODE_UPSERT, LOAD_MODE_SKIP)
+
+def fetch_existing_cufs(cnx, cufs):
+    """Returns the subset of cufs already present in factura_siat, using a single SELECT ... IN query."""
+    cufs = list(cufs)
+    if not cufs:
+        return set()
+    cursor = cnx.cursor()
     try:
-        db_config = get_db_config(config_file_path)
-        print(f"Configuración de Base de Datos cargada desde '{config_file_path}':")
-        print(f"  Host: {db_config.get('host')}")
-        print(f"  User: {db_config.get('user')}")
-        print(f"  Database: {db_config.get('database')}")
-        # No mostrar la contraseña
-
-        print(f"Intentando conectar a la base de datos '{db_config.get('database')}' en '{db_config.get('host')}'...")
-        cnx = connect_to_db(db_config) # This function already tries to connect to the specific DB
-        
-        if cnx and cnx.is_connected():
-            print(f"¡Conexión exitosa a la base de datos '{db_config.get('database')}'!")
-            # Adicionalmente, podríamos verificar si la base de datos realmente existe
-            # consultando el catálogo, pero connect_to_db ya falla si la DB no existe.
-            # cursor = cnx.cursor()
-            # cursor.execute(f"SHOW DATABASES LIKE '{db_config.get('database')}';")
-            # result = cursor.fetchone()
-            # if result:
-            #     print(f"La base de datos '{db_config.get('database')}' existe en el servidor.")
-            # else:
-            #     print(f"ADVERTENCIA: La conexión al servidor fue exitosa, pero la base de datos '{db_config.get('database')}' no parece existir.")
-            # cursor.close()
-            cnx.close()
-            db_connection_ok = True
-        else:
-            # connect_to_db ya imprime un error si falla
-            print("Fallo al conectar con la base de datos (ver mensaje anterior si existe).")
-            
-    except FileNotFoundError:
-        print(f"Error: Archivo de configuración '{config_file_path}' no encontrado para la sección [DATABASE].")
-    except ValueError as e: 
-        print(f"Error en la sección [DATABASE] del archivo de configuración: {e}")
-    except mysql.connector.Error as err:
-        print(f"Error de MySQL al conectar/verificar la base de datos: {err}")
-        if err.errno == 1049: # Error code for "Unknown database"
-             print(f"  Detalle: La base de datos '{db_config.get('database', 'N/A')}' no existe en el servidor '{db_config.get('host', 'N/A')}'.")
-        elif err.errno == 1045: # Error code for "Access denied"
-            print(f"  Detalle: Acceso denegado para el usuario '{db_config.get('user', 'N/A')}' en '{db_config.get('host', 'N/A')}'. Verifica usuario y contraseña.")
-    except Exception as e:
-        print(f"Un error inesperado ocurrió durante la prueba de conexión a la BD: {e}")
-    print("--- Prueba de Base de Datos Finalizada ---")
+        cursor.execute(f"SELECT cuf FROM factura_siat WHERE cuf IN ({', '.join(['%s'] * len(cufs))})", cufs)
+        return {row[0] for row in cursor.fetchall()}
+    finally:
+        cursor.close()
 
-    # --- Prueba de Conexión a DigitalOcean Spaces --- (Código existente de test_spaces_connection)
-    print("\\n--- Prueba de Conexión a DigitalOcean Spaces ---")
+def _write_chunk(cnx, cursor, chunk, mode):
+    """Sends one chunk with the statement for mode; returns the number of rows sent."""
+    if mode == LOAD_MODE_SKIP:
+        cuf_index = FACTURA_SIAT_COLUMNS.index("cuf")
+        existing = fetch_existing_cufs(cnx, {row[cuf_index] for row in chunk})
+        unique_rows = {}
+        for row in chunk:
+            if row[cuf_index] not in existing:
+                unique_rows.setdefault(row[cuf_index], row)
+        chunk = list(unique_rows.values())
+        if not chunk:
+            return 0
+    with metrics.timer("insert"):
+        cursor.executemany(UPSERT_FACTURA_SIAT_SQL if mode == LOAD_MODE_UPSERT else INSERT_FACTURA_SIAT_SQL, chunk)
+    return len(chunk)
+
+def insert_rows(cnx, rows, batch_size=500, commit_interval=1, mode=LOAD_MODE_INSERT):
+    """
+    Inserts factura_siat rows (tuples ordered as FACTURA_SIAT_COLUMNS) with a parameterized
+    executemany, which mysql.connector sends as multi-row INSERT statements.
+    rows may be any iterable; it is consumed in chunks of batch_size and the transaction is
+    committed every commit_interval chunks and once at the end.
+    mode makes re-runs idempotent on cuf: LOAD_MODE_UPSERT updates rows that already exist and
+    LOAD_MODE_SKIP prefetches the existing CUFs of each chunk in one query and only sends the new ones.
+    Returns the number of rows sent. On error the uncommitted chunks are rolled back and
+    the mysql.connector.Error is re-raised.
+    """
+    import mysql.connector
+
+    if mode not in LOAD_MODES:
+        raise ValueError(f"Modo de carga desconocido: {mode}")
+    cursor = cnx.cursor()
+    inserted = 0
+    pending_chunks = 0
+    chunk = []
     try:
-        spaces_config = get_spaces_config(config_file_path)
-        print(f"Configuración de Spaces cargada desde '{config_file_path}':")
-        print(f"  Endpoint URL: {spaces_config.get('endpoint_url')}")
-        print(f"  Region Name: {spaces_config.get('region_name')}")
-        print(f"  Access Key ID: {spaces_config.get('aws_access_key_id')[:5]}... (oculto)")
-
-        session = boto3.session.Session()
-        client = session.client('s3',
-                                region_name=spaces_config['region_name'],
-                                endpoint_url=spaces_config['endpoint_url'],
-                                aws_access_key_id=spaces_config['aws_access_key_id'],
-                                aws_secret_access_key=spaces_config['aws_secret_access_key'])
-
-        print("Intentando listar buckets...")
-        response = client.list_buckets()
-        
-        print("¡Conexión exitosa a DigitalOcean Spaces!")
-        buckets = [bucket['Name'] for bucket in response.get('Buckets', [])]
-        if buckets:
-            print("Buckets encontrados:")
-            for bucket_name in buckets:
-                print(f"  - {bucket_name}")
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= batch_size:
+                inserted += _write_chunk(cnx, cursor, chunk, mode)
+                chunk = []
+                pending_chunks += 1
+                if pending_chunks >= commit_interval:
+                    with metrics.timer("commit"):
+                        cnx.commit()
+                    pending_chunks = 0
+        if chunk:
+            inserted += _write_chunk(cnx, cursor, chunk, mode)
+            pending_chunks += 1
+        if pending_chunks:
+            with metrics.timer("commit"):
+                cnx.commit()
+        metrics.incr("rows_inserted", inserted)
+        return inserted
+    except mysql.connector.Error:
+        metrics.incr("insert_failed")
+        cnx.rollback()
+        raise
+    finally:
+        cursor.close()
+
+def _log_check_result(result, config_file_path):
+    """Logs one healthcheck result with a hint for the usual configuration errors."""
+    if result["ok"]:
+        logger.info("  OK (%s ms%s)", result["latency_ms"], ", en caché" if result["cached"] else "")
+        return
+    code = result["error_code"]
+    logger.error("  FALLO: %s (Código: %s)", result["error"], code)
+    if code == "config":
+        logger.error("  Sugerencia: revisa el archivo de configuración '%s'.", config_file_path)
+    elif code == 1049:  # Unknown database
+        logger.error("  Detalle: La base de datos configurada no existe en el servidor.")
+    elif code == 1045:  # Access denied
+        logger.error("  Detalle: Acceso denegado. Verifica usuario y contraseña.")
+    elif code == "InvalidAccessKeyId":
+        logger.error("  Sugerencia: Verifica tu 'aws_access_key_id'.")
+    elif code == "SignatureDoesNotMatch":
+        logger.error("  Sugerencia: Verifica tu 'aws_secret_access_key' y asegúrate de que el 'endpoint_url' y 'region_name' sean correctos y coincidan.")
+        logger.error("              Asegúrate también de que la hora de tu sistema esté sincronizada.")
+    elif code in ("404", "NoSuchBucket"):
+        logger.error("  Sugerencia: El bucket configurado en 'bucket_name' no existe.")
+    elif code in ("403", "AccessDenied"):
+        logger.error("  Sugerencia: Las credenciales no tienen acceso al bucket configurado.")
+    elif code in ("TimeoutError", "ConnectTimeoutError", "ReadTimeoutError", "EndpointConnectionError"):
+        logger.error("  Sugerencia: Verifica el host/endpoint y que sea alcanzable desde esta máquina.")
+
+def run_connectivity_checks(config_file_path="db_config.ini", connect_timeout=3.0, read_timeout=5.0):
+    """
+    Prueba la conexión a la base de datos y a DigitalOcean Spaces.
+    Ambas pruebas (SELECT 1 y HEAD del bucket) corren en paralelo con los timeouts indicados,
+    ver src/healthcheck.py; check_health devuelve los mismos resultados como datos.
+    Devuelve True si ambas conexiones funcionan.
+    """
+    from .healthcheck import CHECK_DATABASE, CHECK_SPACES, check_health
+
+    logger.info("--- Iniciando Pruebas de Conectividad ---")
+    report = check_health(config_file_path, force=True, connect_timeout=connect_timeout, read_timeout=read_timeout)
+    logger.info("\\n--- Prueba de Conexión a la Base de Datos ---")
+    _log_check_result(report["checks"][CHECK_DATABASE], config_file_path)
+    logger.info("\\n--- Prueba de Conexión a DigitalOcean Spaces ---")
+    _log_check_result(report["checks"][CHECK_SPACES], config_file_path)
+
+    logger.info("\\n--- Resumen de Pruebas de Conectividad ---")
+    logger.info("Conexión a Base de Datos: %s", 'ÉXITO' if report["checks"][CHECK_DATABASE]["ok"] else 'FALLO')
+    logger.info("Conexión a DigitalOcean Spaces: %s", 'ÉXITO' if report["checks"][CHECK_SPACES]["ok"] else 'FALLO')
+    logger.info("-----------------------------------------")
+    return report["ok"]
+
+
+@dataclass(frozen=True, slots=True)
+class FieldSpec:
+    """
+    One entry of the declarative factura_siat field map.
+    tag is the cabecera child the value is read from (None for the values supplied by to_row),
+    type converts its text, and a missing non-nullable field makes the extraction fail.
+    Entries with column=False are extracted (e.g. for validation) but not inserted.
+    check, if set, is called with the text of a present value and raises ValueError when it is
+    malformed, so the problem surfaces as an extraction error and not when the row is built.
+    """
+    name: str
+    tag: str | None
+    type: type = str
+    nullable: bool = True
+    column: bool = True
+    check: object = None
+
+# Valor fijo de codigoRecepcion para las facturas emitidas con el SIAT de escritorio
+CODIGO_RECEPCION = "siatDesktop"
+
+# fechaEmision as sent by the SIAT (2024-01-31T10:20:30.123); to_row splits it at the T
+_FECHA_EMISION_RE = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?")
+
+def _check_fecha_emision(text):
+    if not _FECHA_EMISION_RE.fullmatch(text):
+        raise ValueError(f"fechaEmision inválida: '{text}'")
+
+# Mapa de campos: el orden de las columnas es el de los parámetros del INSERT
+FACTURA_SIAT_FIELDS = (
+    FieldSpec("factura_id", None, int),
+    FieldSpec("numeroFactura", "numeroFactura", column=False),
+    FieldSpec("cuf", "cuf", nullable=False),
+    FieldSpec("cufd", "cufd", nullable=False),
+    FieldSpec("codigoSucursal", "codigoSucursal", int, nullable=False),
+    FieldSpec("codigoPuntoVenta", "codigoPuntoVenta", int, nullable=False),
+    FieldSpec("fechaEmision", "fechaEmision", nullable=False, check=_check_fecha_emision),
+    FieldSpec("codigoTipoDocumentoIdentidad", "codigoTipoDocumentoIdentidad", int, nullable=False),
+    FieldSpec("numeroDocumento", "numeroDocumento", nullable=False),
+    FieldSpec("complemento", "complemento"),
+    FieldSpec("nombreRazonSocial", "nombreRazonSocial", nullable=False),
+    FieldSpec("leyenda", "leyenda"),
+    FieldSpec("pedido", None),
+    FieldSpec("cafc", "cafc"),
+    FieldSpec("codigoRecepcion", None),
+    FieldSpec("codigoMetodoPago", "codigoMetodoPago", int),
+    FieldSpec("numeroTarjeta", "numeroTarjeta"),
+    FieldSpec("montoTotal", "montoTotal", Decimal),
+    FieldSpec("montoTotalMoneda", "montoTotalMoneda", Decimal),
+    FieldSpec("tipoCambio", "tipoCambio", Decimal),
+    FieldSpec("created_at", None),
+)
+
+FACTURA_SIAT_COLUMNS = tuple(field.name for field in FACTURA_SIAT_FIELDS if field.column)
+
+INSERT_FACTURA_SIAT_SQL = (
+    f"INSERT INTO factura_siat ({', '.join(FACTURA_SIAT_COLUMNS)}) "
+    f"VALUES ({', '.join(['%s'] * len(FACTURA_SIAT_COLUMNS))})"
+)
+
+UPSERT_FACTURA_SIAT_SQL = INSERT_FACTURA_SIAT_SQL + " ON DUPLICATE KEY UPDATE " + ", ".join(
+    f"{column} = VALUES({column})" for column in FACTURA_SIAT_COLUMNS if column != "cuf"
+)
+
+# Columnas sin tag en el mapa, en el orden en que to_row las agrega
+SUPPLIED_COLUMNS = ("factura_id", "pedido", "codigoRecepcion", "created_at")
+
+def _compile_row_builder(field_map):
+    """
+    Returns (xml_values, order): xml_values(factura) gets the XML columns as a tuple and order
+    picks the factura_siat columns, in map order, from xml_values + the SUPPLIED_COLUMNS values.
+    Both are operator getters, so building a row does not loop in Python.
+    """
+    xml_columns = [field.name for field in field_map if field.column and field.tag]
+    positions = []
+    for field in field_map:
+        if not field.column:
+            continue
+        if field.tag:
+            positions.append(xml_columns.index(field.name))
+        elif field.name in SUPPLIED_COLUMNS:
+            positions.append(len(xml_columns) + SUPPLIED_COLUMNS.index(field.name))
         else:
-            print("No se encontraron buckets (o no tienes permiso para listarlos).")
-        spaces_connection_ok = True
+            raise ValueError(f"La columna '{field.name}' no tiene tag ni es una de {SUPPLIED_COLUMNS}")
+    return attrgetter(*xml_columns), itemgetter(*positions)
 
-    except FileNotFoundError:
-        print(f"Error: Archivo de configuración '{config_file_path}' no encontrado para la sección [SPACES].")
-    except ValueError as e: 
-        print(f"Error en la configuración de Spaces: {e}")
-    except (NoCredentialsError, PartialCredentialsError):
-        print("Error: Credenciales de AWS/Spaces no encontradas o incompletas.")
-    except ClientError as e:
-        error_code = e.response.get("Error", {}).get("Code")
-        print(f"Error de Cliente al conectar con Spaces: {e} (Código: {error_code})")
-        if error_code == "InvalidAccessKeyId":
-            print("  Sugerencia: Verifica tu 'aws_access_key_id'.")
-        elif error_code == "SignatureDoesNotMatch":
-            print("  Sugerencia: Verifica tu 'aws_secret_access_key' y asegúrate de que el 'endpoint_url' y 'region_name' sean correctos y coincidan.")
-            print("              Asegúrate también de que la hora de tu sistema esté sincronizada.")
-        elif error_code == "InvalidRequest" and "The authorization mechanism you have provided is not supported. Please use AWS4-HMAC-SHA256" in str(e):
-             print("  Sugerencia: El endpoint o la región podrían no estar configurados para usar la firma v4. Revisa la configuración de tu cliente S3 o el endpoint.")
-    except Exception as e:
-        print(f"Un error inesperado ocurrió durante la prueba de conexión a Spaces: {e}")
-    
-    print("--- Prueba de Spaces Finalizada ---")
-    print("\\n--- Resumen de Pruebas de Conectividad ---")
-    print(f"Conexión a Base de Datos: {'ÉXITO' if db_connection_ok else 'FALLO'}")
-    print(f"Conexión a DigitalOcean Spaces: {'ÉXITO' if spaces_connection_ok else 'FALLO'}")
-    print("-----------------------------------------")
-    return db_connection_ok and spaces_connection_ok
+_xml_column_values, _row_order = _compile_row_builder(FACTURA_SIAT_FIELDS)
 
+@dataclass(slots=True)
+class FacturaSiat:
+    """
+    Invoice header fields extracted once from a SIAT XML cabecera: one attribute per entry of
+    FACTURA_SIAT_FIELDS with a tag, in map order (checked at import time).
+    """
+    numeroFactura: str | None
+    cuf: str
+    cufd: str
+    codigoSucursal: int
+    codigoPuntoVenta: int
+    fechaEmision: str
+    codigoTipoDocumentoIdentidad: int
+    numeroDocumento: str
+    complemento: str | None
+    nombreRazonSocial: str
+    leyenda: str | None
+    cafc: str | None
+    codigoMetodoPago: int | None
+    numeroTarjeta: str | None
+    montoTotal: Decimal | None
+    montoTotalMoneda: Decimal | None
+    tipoCambio: Decimal | None
 
-def parse_xml_and_generate_insert(xml_string, factura_id, pedido=None):
+    def to_row(self, factura_id, pedido=None):
+        """Returns the factura_siat values as a tuple ordered as FACTURA_SIAT_COLUMNS."""
+        # Formatear las fechas para la base de datos
+        fecha, hora = self.fechaEmision.split("T")
+        created_at = fecha + " " + hora.split('.')[0] # Ensure correct time format
+        return _row_order(_xml_column_values(self) + (factura_id, pedido or None, CODIGO_RECEPCION, created_at))
+
+def _check_record_fields(record_type, field_map):
+    """Raises TypeError unless record_type has one field per map entry with a tag, in map order and type."""
+    expected = [(field.name, field.type if not field.nullable else field.type | None)
+                for field in field_map if field.tag]
+    actual = [(field.name, field.type) for field in fields(record_type)]
+    if actual != expected:
+        raise TypeError(f"Los campos de {record_type.__name__} no coinciden con el mapa de campos: "
+                        f"{actual} != {expected}")
+
+_check_record_fields(FacturaSiat, FACTURA_SIAT_FIELDS)
+
+def compile_extractor(field_map, record_type):
     """
-    Parse XML content and generate SQL INSERT statement
+    Compiles a field map into a function cabecera -> record_type(...), with one argument per
+    field that has a tag, in map order.
+    The function makes a single pass over the cabecera children into a tag -> text dict and
+    then picks every field from it, so adding a field adds no tree lookup. Only the fields
+    whose type is not str are converted, and fields with a check are validated first. Nil
+    elements (e.g. <complemento xsi:nil="true"/>) count as missing.
     """
+    xml_fields = [field for field in field_map if field.tag]
+    tags = [field.tag for field in xml_fields]
+    converters = [(index, field.type) for index, field in enumerate(xml_fields) if field.type is not str]
+    required = [(index, field.tag) for index, field in enumerate(xml_fields) if not field.nullable]
+    required_values = itemgetter(*[index for index, _ in required]) if required else None
+    checks = [(index, field.check) for index, field in enumerate(xml_fields) if field.check]
+
+    def extract(cabecera):
+        texts = {child.tag: child.text for child in cabecera}
+        values = list(map(texts.get, tags))
+        if required_values is not None and None in required_values(values):
+            missing = [tag for index, tag in required if values[index] is None]
+            raise ValueError(f"Faltan campos obligatorios en la cabecera: {', '.join(missing)}")
+        for index, check in checks:
+            if values[index] is not None:
+                check(values[index])
+        for index, convert in converters:
+            text = values[index]
+            if text is not None:
+                values[index] = convert(text)
+        return record_type(*values)
+
+    return extract
+
+# Builds a FacturaSiat from a cabecera element with a single pass over its children
+factura_from_cabecera = compile_extractor(FACTURA_SIAT_FIELDS, FacturaSiat)
+
+def extract_factura(xml_string):
+    """Parses the XML content once and returns its FacturaSiat record."""
     root = ET.fromstring(xml_string)
-    cabecera = root.find(".//cabecera")
-    
-    # Extraer datos del XML
-    cuf = cabecera.find("cuf").text
-    cufd = cabecera.find("cufd").text
-    codigoSucursal = cabecera.find("codigoSucursal").text
-    codigoPuntoVenta = cabecera.find("codigoPuntoVenta").text
-    fechaEmision = cabecera.find("fechaEmision").text
-    codigoTipoDocumentoIdentidad = cabecera.find("codigoTipoDocumentoIdentidad").text
-    numeroDocumento = cabecera.find("numeroDocumento").text
-    complemento_element = cabecera.find("complemento")
-    complemento = complemento_element.text if complemento_element is not None and complemento_element.text else "NULL"
-    nombreRazonSocial = cabecera.find("nombreRazonSocial").text
-    leyenda_element = cabecera.find("leyenda")
-    leyenda = leyenda_element.text if leyenda_element is not None and leyenda_element.text else "NULL"
-    cafc_element = cabecera.find("cafc")
-    cafc = cafc_element.text if cafc_element is not None and cafc_element.text else "NULL"
-    codigoRecepcion = "siatDesktop" # Assuming this is a fixed value or needs to be sourced differently
-    codigoMetodoPago_element = cabecera.find("codigoMetodoPago")
-    codigoMetodoPago = codigoMetodoPago_element.text if codigoMetodoPago_element is not None and codigoMetodoPago_element.text else "NULL"
-    numeroTarjeta_element = cabecera.find("numeroTarjeta")
-    numeroTarjeta = numeroTarjeta_element.text if numeroTarjeta_element is not None and numeroTarjeta_element.text else "NULL"
-    montoTotal_element = cabecera.find("montoTotal")
-    montoTotal = montoTotal_element.text if montoTotal_element is not None and montoTotal_element.text else "NULL"
-    montoTotalMoneda_element = cabecera.find("montoTotalMoneda")
-    montoTotalMoneda = montoTotalMoneda_element.text if montoTotalMoneda_element is not None and montoTotalMoneda_element.text else "NULL"
-    tipoCambio_element = cabecera.find("tipoCambio")
-    tipoCambio = tipoCambio_element.text if tipoCambio_element is not None and tipoCambio_element.text else "NULL"
-    
-    # Formatear las fechas para la base de datos
-    created_at = fechaEmision.split("T")[0] + " " + fechaEmision.split("T")[1].split('.')[0] # Ensure correct time format
-    
-    # Construir la consulta INSERT
-    # Ensure proper quoting for string values and handling of NULLs
+    return factura_from_cabecera(root.find(".//cabecera"))
+
+def extract_factura_from_file(xml_path):
+    """
+    Extracts the FacturaSiat record from an XML file with a pull parser (lxml when installed)
+    fed in _PARSE_CHUNK_SIZE chunks, which avoids iterparse's per-event generator overhead.
+    Parsing stops as soon as the cabecera element is closed and elements outside of it are
+    cleared as they complete, so memory and latency do not grow with the number of detalle lines.
+    """
+    try:
+        with metrics.timer("parse"):
+            factura = _pull_parse_factura(xml_path)
+    except Exception:
+        metrics.incr("parse_failed")
+        raise
+    metrics.incr("files_parsed")
+    return factura
+
+def _pull_parse_factura(xml_path):
+    parser = _XMLPullParser(events=("start", "end"))
+    depth = 0
+    root = None
+    with open(xml_path, 'rb') as file:
+        for data in iter(lambda: file.read(_PARSE_CHUNK_SIZE), b""):
+            parser.feed(data)
+            for event, elem in parser.read_events():
+                if event == "start":
+                    if root is None:
+                        root = elem
+                    depth += 1
+                    continue
+                depth -= 1
+                if elem.tag == "cabecera":
+                    return factura_from_cabecera(elem)
+                if depth == 1:
+                    # A completed top-level element that did not contain the cabecera
+                    root.clear()
+    raise ValueError(f"No se encontró el elemento cabecera en {xml_path}")
+
+def parse_xml_to_row(xml_string, factura_id, pedido=None):
+    """
+    Parse XML content into a tuple of values for factura_siat, ordered as FACTURA_SIAT_COLUMNS.
+    Missing optional fields are None, so the row can be passed as query parameters.
+    """
+    return extract_factura(xml_string).to_row(factura_id, pedido)
+
+def _sql_literal(value):
+    """Renders a row value as a MySQL literal, escaping quotes and backslashes in strings."""
+    if value is None:
+        return "NULL"
+    if isinstance(value, (int, Decimal)):
+        return str(value)
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "''") + "'"
+
+def generate_insert_sql(factura, factura_id, pedido=None):
+    """Generates the SQL INSERT statement for an already extracted FacturaSiat."""
+    row = factura.to_row(factura_id, pedido)
     query = f"""
     INSERT INTO factura_siat (
-        factura_id, cuf, cufd, codigoSucursal, codigoPuntoVenta, fechaEmision,
-        codigoTipoDocumentoIdentidad, numeroDocumento, complemento, nombreRazonSocial,
-        leyenda, pedido, cafc, codigoRecepcion, codigoMetodoPago, numeroTarjeta,
-        montoTotal, montoTotalMoneda, tipoCambio, created_at
+        {', '.join(FACTURA_SIAT_COLUMNS)}
     ) VALUES (
-        {factura_id}, '{cuf}', '{cufd}', {codigoSucursal}, {codigoPuntoVenta}, '{fechaEmision}',
-        {codigoTipoDocumentoIdentidad}, '{numeroDocumento}', {f"'{complemento}'" if complemento not in ["NULL", None] else "NULL"}, '{nombreRazonSocial}',
-        {f"'{leyenda}'" if leyenda not in ["NULL", None] else "NULL"}, {f"'{pedido}'" if pedido else "NULL"}, {f"'{cafc}'" if cafc not in ["NULL", None] else "NULL"},
-        '{codigoRecepcion}', {codigoMetodoPago if codigoMetodoPago not in ["NULL", None] else "NULL"}, {f"'{numeroTarjeta}'" if numeroTarjeta not in ["NULL", None] else "NULL"},
-        {montoTotal if montoTotal not in ["NULL", None] else "NULL"}, {montoTotalMoneda if montoTotalMoneda not in ["NULL", None] else "NULL"}, {tipoCambio if tipoCambio not in ["NULL", None] else "NULL"}, '{created_at}'
+        {', '.join(_sql_literal(value) for value in row)}
     );
     """
     return query.strip()
 
-def find_xml_by_cuf(cuf, base_path="."):
+def parse_xml_and_generate_insert(xml_string, factura_id, pedido=None):
+    """
+    Parse XML content and generate SQL INSERT statement
+    """
+    return generate_insert_sql(extract_factura(xml_string), factura_id, pedido)
+
+def find_xml_by_cuf(cuf, base_path=".", index_path=None):
     """
     Search for XML file by CUF in any directory under base_path.
+    If index_path is given the persistent CUF index is used instead of walking the tree.
     Returns the full path to the XML file if found, None otherwise.
     """
     try:
-        for root, dirs, files in os.walk(base_path):
-            if f"{cuf}.xml" in files:
-                return os.path.join(root, f"{cuf}.xml")
-        return None
+        with metrics.timer("lookup"):
+            xml_path = _find_xml_path(cuf, base_path, index_path)
+        metrics.incr("files_found" if xml_path else "files_not_found")
+        return xml_path
     except Exception as e:
-        print(f"Error searching for XML file: {e}")
+        logger.error("Error searching for XML file: %s", e)
         return None
 
+def _find_xml_path(cuf, base_path, index_path):
+    if index_path:
+        return find_xml_in_index(cuf, base_path, index_path)
+    for root, dirs, files in os.walk(base_path):
+        if f"{cuf}.xml" in files:
+            return os.path.join(root, f"{cuf}.xml")
+    return None
+
 def get_spaces_config(config_file_path="db_config.ini"):
-    """Reads DigitalOcean Spaces configuration from an INI file."""
-    config = configparser.ConfigParser()
-    if not os.path.exists(config_file_path):
-        raise FileNotFoundError(f"Configuration file {config_file_path} not found.")
-    config.read(config_file_path)
+    """Reads DigitalOcean Spaces configuration from an INI file (cached, see load_config)."""
+    config = load_config(config_file_path)
     if 'SPACES' not in config:
         raise ValueError("SPACES section not found in the configuration file.")
     return config['SPACES']
@@ -234,130 +504,116 @@ def upload_to_spaces(spaces_config, local_file_path, spaces_file_key):
     """
     Uploads a file to DigitalOcean Spaces.
     Ensures the ContentType is set to application/xml.
+    The S3 client is created once per configuration and reused across calls, and files whose
+    content is already in Spaces (same SHA-256/ETag) are skipped.
     """
-    try:
-        session = boto3.session.Session()
-        client = session.client('s3',
-                                region_name=spaces_config['region_name'],
-                                endpoint_url=spaces_config['endpoint_url'],
-                                aws_access_key_id=spaces_config['aws_access_key_id'],
-                                aws_secret_access_key=spaces_config['aws_secret_access_key'])
-
-        client.upload_file(
-            Filename=local_file_path,
-            Bucket=spaces_config['bucket_name'],
-            Key=spaces_file_key,
-            ExtraArgs={
-                'ACL': 'public-read',
-                'ContentType': 'application/xml'  # Explicitly set ContentType
-            }
-        )
-        print(f"Archivo '{os.path.basename(local_file_path)}' subido exitosamente a Spaces como '{spaces_file_key}'.")
-        # Construct and print the public URL
-        public_url = f"{spaces_config['endpoint_url']}/{spaces_config['bucket_name']}/{spaces_file_key}"
-        print(f"URL pública: {public_url}")
-        return True, public_url
-    except FileNotFoundError:
-        print(f"Error: El archivo local '{local_file_path}' no fue encontrado.")
-        return False, None
-    except (NoCredentialsError, PartialCredentialsError):
-        print("Error: Credenciales de AWS/Spaces no encontradas o incompletas. Asegúrese de que estén configuradas en db_config.ini.")
-        return False, None
-    except ClientError as e:
-        # More specific error handling for S3-related errors
-        error_code = e.response.get("Error", {}).get("Code")
-        if error_code == "InvalidAccessKeyId":
-            print("Error: AWS Access Key ID inválido.")
-        elif error_code == "SignatureDoesNotMatch":
-            print("Error: AWS Secret Access Key inválido.")
-        elif error_code == "NoSuchBucket":
-            print(f"Error: El bucket '{spaces_config['bucket_name']}' no existe.")
-        else:
-            print(f"Error de Cliente al subir a Spaces: {e} (Código: {error_code})")
-        return False, None
-    except Exception as e:
-        print(f"Un error inesperado ocurrió al subir a Spaces: {e}")
-        return False, None
+    return get_spaces_uploader(spaces_config, skip_unchanged=True).upload(local_file_path, spaces_file_key)
 
-def process_factura_by_cuf(cuf, factura_id, base_path=".", pedido=None, numero_factura=None, total_factura=None):
+def validate_factura(factura, numero_factura=None, total_factura=None):
+    """
+    Validates invoice number and total amount against an extracted FacturaSiat.
+    Returns None if everything matches, or a description of the mismatch.
+    """
+    if numero_factura is not None:
+        xml_numero = factura.numeroFactura
+        if xml_numero != numero_factura:
+            return f"El número de factura proporcionado ({numero_factura}) no coincide con el XML ({xml_numero})"
+
+    if total_factura is not None:
+        if factura.montoTotal is None:
+            return f"El monto total proporcionado ({total_factura}) no coincide con el XML (sin montoTotal)"
+        xml_total = float(factura.montoTotal)
+        if abs(xml_total - total_factura) > 0.01:  # Using small epsilon for float comparison
+            return f"El monto total proporcionado ({total_factura}) no coincide con el XML ({xml_total})"
+    return None
+
+def process_factura_by_cuf(cuf, factura_id, base_path=".", pedido=None, numero_factura=None, total_factura=None, index_path=None):
     """
     Process invoice by CUF, finding the XML file and generating the SQL insert.
     Validates invoice number and total amount if provided.
     Returns a tuple (sql_query, xml_file_path) if successful, (None, None) otherwise.
     """
-    xml_path = find_xml_by_cuf(cuf, base_path)
+    xml_path = find_xml_by_cuf(cuf, base_path, index_path)
     if not xml_path:
-        print(f"No se encontró el archivo XML para el CUF: {cuf}")
+        logger.error("No se encontró el archivo XML para el CUF: %s", cuf)
         return None, None
     
     try:
-        with open(xml_path, 'r', encoding='utf-8') as file:
-            xml_string = file.read()
-        
+        # Parse once (only up to the cabecera); validation and SQL generation share the same record
+        factura = extract_factura_from_file(xml_path)
+
         # Validate invoice number and total amount if provided
-        root = ET.fromstring(xml_string)
-        cabecera = root.find(".//cabecera")
-        
-        if numero_factura is not None:
-            xml_numero = cabecera.find("numeroFactura").text
-            if xml_numero != numero_factura:
-                print(f"Error de validación: El número de factura proporcionado ({numero_factura}) no coincide con el XML ({xml_numero})")
-                return None, None
-        
-        if total_factura is not None:
-            xml_total = float(cabecera.find("montoTotal").text)
-            if abs(xml_total - total_factura) > 0.01:  # Using small epsilon for float comparison
-                print(f"Error de validación: El monto total proporcionado ({total_factura}) no coincide con el XML ({xml_total})")
-                return None, None
+        error_validacion = validate_factura(factura, numero_factura, total_factura)
+        if error_validacion:
+            logger.error("Error de validación: %s", error_validacion)
+            return None, None
             
-        sql_query = parse_xml_and_generate_insert(xml_string, factura_id, pedido)
+        sql_query = generate_insert_sql(factura, factura_id, pedido)
         return sql_query, xml_path
     except Exception as e:
-        print(f"Error procesando el archivo XML: {e}")
+        logger.error("Error procesando el archivo XML: %s", e)
         return None, None
 
-def procesar_e_insertar_factura(cuf, factura_id, base_path, config_file, pedido=None, numero_factura=None, total_factura=None):
+def _encolar_paso(outbox_path, step, cuf, xml_file_path, factura_id, pedido):
+    """Records a failed step in the outbox so `main.py outbox drenar` retries it."""
+    from .outbox import Outbox
+
+    outbox = Outbox(outbox_path)
+    try:
+        outbox.enqueue(cuf, xml_file_path, factura_id, pedido, steps=(step,))
+    finally:
+        outbox.close()
+    logger.warning("El paso '%s' quedó pendiente en el outbox '%s' para reintentarse.", step, outbox_path)
+
+def procesar_e_insertar_factura(cuf, factura_id, base_path, config_file, pedido=None, numero_factura=None, total_factura=None, index_path=None, outbox_path=None):
     """
     Procesa una factura por su CUF, valida los datos si se proporcionan, genera el SQL, 
     opcionalmente la inserta en la BD y opcionalmente sube el XML a DigitalOcean Spaces.
+    Si se indica index_path, el XML se busca en el índice persistente de CUFs.
+    Si se indica outbox_path, la inserción o la subida que fallen quedan encoladas en ese
+    outbox para reintentarse por separado (ver src/outbox.py).
     """
-    sql_query, xml_file_path = process_factura_by_cuf(cuf, factura_id, base_path, pedido, numero_factura, total_factura)
+    sql_query, xml_file_path = process_factura_by_cuf(cuf, factura_id, base_path, pedido, numero_factura, total_factura, index_path)
     if not sql_query:
         # Error message already printed by process_factura_by_cuf
         return
 
-    print("SQL generado exitosamente:")
-    print(sql_query)
+    logger.info("SQL generado exitosamente:")
+    logger.info("%s", sql_query)
 
     # Database insertion logic (existing)
     try:
         db_config = get_db_config(config_file)
-        print("\\nDatos de conexión a la base de datos:")
+        logger.info("\\nDatos de conexión a la base de datos:")
         for key, value in db_config.items():
             if key.lower() == 'password':
-                print(f"{key.capitalize()}: ********")
+                logger.info("%s: ********", key.capitalize())
             else:
-                print(f"{key.capitalize()}: {value}")
+                logger.info("%s: %s", key.capitalize(), value)
 
         respuesta_db = input("¿Desea insertar estos datos en la base de datos? (s/n): ").strip().lower()
         if respuesta_db == 's':
-            cnx = connect_to_db(db_config)
+            cnx = connect_to_db(db_config, pooled=True)
+            insertado = False
             if cnx:
-                if execute_sql(cnx, sql_query):
-                    print("Datos insertados correctamente en la base de datos.")
+                insertado = execute_sql(cnx, sql_query)
+                if insertado:
+                    logger.info("Datos insertados correctamente en la base de datos.")
                 else:
-                    print("No se pudieron insertar los datos en la base de datos.")
+                    logger.error("No se pudieron insertar los datos en la base de datos.")
                 cnx.close()
             else:
-                print("No se pudo establecer la conexión con la base de datos.")
+                logger.error("No se pudo establecer la conexión con la base de datos.")
+            if not insertado and outbox_path:
+                _encolar_paso(outbox_path, "db", cuf, xml_file_path, factura_id, pedido)
         else:
-            print("Inserción en la base de datos cancelada por el usuario.")
+            logger.warning("Inserción en la base de datos cancelada por el usuario.")
     except FileNotFoundError:
-        print(f"Error: Archivo de configuración '{config_file}' no encontrado para la sección [DATABASE].")
+        logger.error("Error: Archivo de configuración '%s' no encontrado para la sección [DATABASE].", config_file)
     except ValueError as e:
-        print(f"Error en la sección [DATABASE] del archivo de configuración: {e}")
+        logger.error("Error en la sección [DATABASE] del archivo de configuración: %s", e)
     except Exception as e:
-        print(f"Ocurrió un error inesperado durante la interacción con la base de datos: {e}")
+        logger.error("Ocurrió un error inesperado durante la interacción con la base de datos: %s", e)
 
     # DigitalOcean Spaces upload logic (new)
     if xml_file_path: # Proceed only if XML path is valid
@@ -366,78 +622,31 @@ def procesar_e_insertar_factura(cuf, factura_id, base_path, config_file, pedido=
             if respuesta_spaces == 's':
                 spaces_config = get_spaces_config(config_file)
                 file_name = os.path.basename(xml_file_path)
-                # Ensure upload_folder ends with a slash if it's not empty
-                upload_folder = spaces_config.get('upload_folder', 'obs/xmls/')
-                if upload_folder and not upload_folder.endswith('/'):
-                    upload_folder += '/'
-                spaces_key = f"{upload_folder}{file_name}"
+                spaces_key = get_spaces_key(spaces_config, xml_file_path)
                 
-                print(f"Intentando subir '{file_name}' a Spaces en la ruta: '{spaces_config['bucket_name']}/{spaces_key}'...")
+                logger.info("Intentando subir '%s' a Spaces en la ruta: '%s/%s'...", file_name, spaces_config['bucket_name'], spaces_key)
                 success, public_url = upload_to_spaces(spaces_config, xml_file_path, spaces_key)
                 # The upload_to_spaces function already prints success/error and URL
+                if not success and outbox_path:
+                    _encolar_paso(outbox_path, "upload", cuf, xml_file_path, factura_id, pedido)
             else:
-                print("Subida a DigitalOcean Spaces cancelada por el usuario.")
+                logger.warning("Subida a DigitalOcean Spaces cancelada por el usuario.")
         except FileNotFoundError: 
-            print(f"Error: Archivo de configuración '{config_file}' no encontrado para la sección [SPACES].")
+            logger.error("Error: Archivo de configuración '%s' no encontrado para la sección [SPACES].", config_file)
         except ValueError as e: 
-            print(f"Error en la sección [SPACES] del archivo de configuración: {e}")
+            logger.error("Error en la sección [SPACES] del archivo de configuración: %s", e)
         except Exception as e:
-            print(f"Ocurrió un error inesperado durante la subida a Spaces: {e}")
+            logger.error("Ocurrió un error inesperado durante la subida a Spaces: %s", e)
 
-def test_spaces_connection(config_file_path="db_config.ini"):
+def test_spaces_connection(config_file_path="db_config.ini", connect_timeout=3.0, read_timeout=5.0):
     """
-    Prueba la conexión a DigitalOcean Spaces listando los buckets.
+    Prueba la conexión a DigitalOcean Spaces con un HEAD del bucket configurado.
     """
-    print("\\n--- Iniciando Prueba de Conexión a DigitalOcean Spaces ---")
-    try:
-        spaces_config = get_spaces_config(config_file_path)
-        print(f"Configuración de Spaces cargada desde '{config_file_path}':")
-        print(f"  Endpoint URL: {spaces_config.get('endpoint_url')}")
-        print(f"  Region Name: {spaces_config.get('region_name')}")
-        print(f"  Access Key ID: {spaces_config.get('aws_access_key_id')[:5]}... (oculto)") # Mostrar solo una parte
-        # No mostrar la secret key
-
-        session = boto3.session.Session()
-        client = session.client('s3',
-                                region_name=spaces_config['region_name'],
-                                endpoint_url=spaces_config['endpoint_url'],
-                                aws_access_key_id=spaces_config['aws_access_key_id'],
-                                aws_secret_access_key=spaces_config['aws_secret_access_key'])
-
-        print("Intentando listar buckets...")
-        response = client.list_buckets()
-        
-        print("¡Conexión exitosa a DigitalOcean Spaces!")
-        buckets = [bucket['Name'] for bucket in response.get('Buckets', [])]
-        if buckets:
-            print("Buckets encontrados:")
-            for bucket_name in buckets:
-                print(f"  - {bucket_name}")
-        else:
-            print("No se encontraron buckets (o no tienes permiso para listarlos).")
-        print("--- Prueba de Conexión Finalizada ---")
-        return True
+    from .healthcheck import CHECK_SPACES, check_health
 
-    except FileNotFoundError:
-        print(f"Error: Archivo de configuración '{config_file_path}' no encontrado para la sección [SPACES].")
-    except ValueError as e: # Para errores en la sección [SPACES] o claves faltantes
-        print(f"Error en la configuración de Spaces: {e}")
-    except (NoCredentialsError, PartialCredentialsError):
-        print("Error: Credenciales de AWS/Spaces no encontradas o incompletas. Asegúrese de que estén configuradas correctamente en db_config.ini.")
-    except ClientError as e:
-        error_code = e.response.get("Error", {}).get("Code")
-        print(f"Error de Cliente al conectar con Spaces: {e} (Código: {error_code})")
-        if error_code == "InvalidAccessKeyId":
-            print("  Sugerencia: Verifica tu 'aws_access_key_id'.")
-        elif error_code == "SignatureDoesNotMatch":
-            print("  Sugerencia: Verifica tu 'aws_secret_access_key' y asegúrate de que el 'endpoint_url' y 'region_name' sean correctos y coincidan.")
-            print("              Asegúrate también de que la hora de tu sistema esté sincronizada.")
-        elif error_code == "InvalidRequest" and "The authorization mechanism you have provided is not supported. Please use AWS4-HMAC-SHA256" in str(e):
-             print("  Sugerencia: El endpoint o la región podrían no estar configurados para usar la firma v4. Revisa la configuración de tu cliente S3 o el endpoint.")
-        else:
-            print(f"  Detalles del error del cliente: {e}")
-    except Exception as e:
-        print(f"Un error inesperado ocurrió durante la prueba de conexión a Spaces: {e}")
-    
-    print("--- Prueba de Conexión Finalizada con Errores ---")
-    return False
+    logger.info("\\n--- Iniciando Prueba de Conexión a DigitalOcean Spaces ---")
+    report = check_health(config_file_path, checks=(CHECK_SPACES,), force=True,
+                          connect_timeout=connect_timeout, read_timeout=read_timeout)
+    _log_check_result(report["checks"][CHECK_SPACES], config_file_path)
+    logger.info("--- Prueba de Conexión Finalizada%s ---", "" if report["ok"] else " con Errores")
+    return report["ok"]
@@ -1,5 +1,8 @@
 # filepath: test_do_connection.py
+import logging
+
 from src.xml_to_sql import run_connectivity_checks # Nombre de función actualizado
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     run_connectivity_checks() # Nombre de función actualizado
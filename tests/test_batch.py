@@ -0,0 +1,85 @@
+import csv
+import sqlite3
+from decimal import Decimal
+
+import pytest
+
+pytest.importorskip("mysql.connector")
+
+from benchmarks.run_benchmarks import SQLITE_DDL, _SQLiteCursor
+from benchmarks.synthetic_siat import generate_tree
+from src import batch
+from src.spaces import UPLOAD_UPLOADED
+
+
+class SQLiteConnection:
+    """mysql.connector stand-in backed by one SQLite database shared by every run of the test."""
+
+    def __init__(self):
+        sqlite3.register_adapter(Decimal, str)
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.execute(SQLITE_DDL)
+
+    def get_connection(self):
+        return self
+
+    def cursor(self):
+        return _SQLiteCursor(self.conn.cursor())
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        pass
+
+
+class CrashingUploader:
+    """Uploader that simulates the process dying during the upload of the first group."""
+
+    crash = True
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def upload_many(self, paths):
+        if CrashingUploader.crash:
+            raise KeyboardInterrupt("crash durante la subida")
+        return [(path, UPLOAD_UPLOADED, f"https://spaces/{path}") for path in paths]
+
+
+@pytest.fixture
+def lote(tmp_path, monkeypatch):
+    written = generate_tree(str(tmp_path / "xml"), 20, depth=1, fanout=3, detalles=(1, 3), seed=1)
+    manifest_path = tmp_path / "manifiesto.csv"
+    with open(manifest_path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(["cuf", "factura_id"])
+        for factura_id, (cuf, _) in enumerate(written, start=1):
+            writer.writerow([cuf, factura_id])
+
+    db = SQLiteConnection()
+    monkeypatch.setattr(batch, "get_db_config", lambda config_file: {})
+    monkeypatch.setattr(batch, "get_db_pool", lambda db_config: db)
+    monkeypatch.setattr(batch, "get_spaces_config", lambda config_file: {})
+    monkeypatch.setattr(batch, "SpacesUploader", CrashingUploader)
+    CrashingUploader.crash = True
+    return str(manifest_path), str(tmp_path / "xml"), str(tmp_path / "reporte.jsonl"), db
+
+
+def test_resume_after_crash_during_upload_does_not_insert_again(lote):
+    manifest_path, base_path, report_path, db = lote
+
+    with pytest.raises(KeyboardInterrupt):
+        batch.procesar_lote(manifest_path, base_path, "db_config.ini", report_path, subir=True, batch_size=5)
+    assert db.conn.execute("SELECT COUNT(*) FROM factura_siat").fetchone()[0] == 5
+
+    CrashingUploader.crash = False
+    summary = batch.procesar_lote(manifest_path, base_path, "db_config.ini", report_path, subir=True, batch_size=5)
+
+    assert summary == {"ok": 20}
+    total, distinct = db.conn.execute("SELECT COUNT(*), COUNT(DISTINCT cuf) FROM factura_siat").fetchone()
+    assert (total, distinct) == (20, 20)
+    assert all(result["status"] == "ok" for result in batch.load_report(report_path).values())
@@ -0,0 +1,29 @@
+import csv
+import gzip
+import os
+
+from benchmarks.synthetic_siat import generate_tree
+from src.export import EXPORT_CSV, FILE_COLUMNS, exportar_directorio
+
+
+def test_csv_export_bounds_open_files_and_keeps_every_row(tmp_path):
+    generate_tree(str(tmp_path / "xml"), 60, detalles=(1, 2))
+    output_dir = tmp_path / "export"
+
+    summary = exportar_directorio(str(tmp_path / "xml"), str(output_dir), formato=EXPORT_CSV, max_open_files=2)
+
+    rows = 0
+    part_files = 0
+    partitions = set()
+    for directory, _, names in os.walk(output_dir):
+        for name in names:
+            part_files += 1
+            partitions.add(directory)
+            with gzip.open(os.path.join(directory, name), 'rt', encoding='utf-8', newline='') as file:
+                reader = csv.reader(file)
+                assert tuple(next(reader)) == FILE_COLUMNS
+                rows += sum(1 for _ in reader)
+    assert rows == summary["rows"] == 60
+    assert len(partitions) == summary["partitions"]
+    # Partitions reopened after being evicted get extra part files
+    assert part_files > len(partitions)
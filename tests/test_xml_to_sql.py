@@ -0,0 +1,25 @@
+import random
+import re
+
+import pytest
+
+from benchmarks.synthetic_siat import make_invoice
+from src.xml_to_sql import extract_factura, validate_factura
+
+
+def test_validate_factura_reports_nil_monto_total_as_mismatch():
+    _, xml_text, total = make_invoice(random.Random(0), 1, 2)
+    xml_text = re.sub(r"<montoTotal>[^<]*</montoTotal>", '<montoTotal xsi:nil="true"/>', xml_text)
+    factura = extract_factura(xml_text)
+
+    assert factura.montoTotal is None
+    assert "no coincide" in validate_factura(factura, total_factura=float(total))
+    assert validate_factura(factura) is None
+
+
+def test_extract_factura_rejects_fecha_emision_without_time():
+    _, xml_text, _ = make_invoice(random.Random(0), 1, 2)
+    xml_text = re.sub(r"<fechaEmision>([^<T]*)T[^<]*</fechaEmision>", r"<fechaEmision>\1</fechaEmision>", xml_text)
+
+    with pytest.raises(ValueError, match="fechaEmision"):
+        extract_factura(xml_text)